@@ -3,11 +3,16 @@
 # FFT-accelerated VIE solver using a Cartesian grid.
 # Currently using "DDA" evaluation of all the integrals.
 
+import os
+import sys
+# FIXME: figure out how to avoid this sys.path stuff
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
 import numpy as np
 from scipy.special import hankel1
 from scipy.sparse.linalg import LinearOperator, gmres
 from analytical import penetrable_circle
 from scipy.linalg import toeplitz
+from vines.precondition.block_lu import circ2_factor, circ2_solve
 import time
 
 ko = 40  # Wavenumber
@@ -202,56 +207,23 @@ for i_loop in range(0, M):
                               c_fft[i_loop, 0:N])
     circ[i_loop, :, :] = temp
 
-# Invert preconditioner
-circ_inv = np.zeros_like(circ)
-for i in range(0, M):
-    circ_inv[i, :, :] = np.linalg.inv(np.identity(N) - (refInd**2 - 1) *
-                                      circ[i, :, :])
-
-# def processInput(i):
-#     circ_inv = np.zeros((N, N), dtype=np.complex128)
-#     circ_inv[:, :] = np.linalg.inv(np.identity(N) - (refInd**2 - 1) *
-#                                 circ[i, :, :])
-#     return circ_inv
-
-# from joblib import Parallel, delayed  
-# import multiprocessing
-# inputs = range(M)
-
-# num_cores = multiprocessing.cpu_count()
-
-# print("numCores = " + str(num_cores))
-
-# results = Parallel(n_jobs=num_cores)(delayed(processInput)(i) for i in inputs) 
-# circ_inv = np.asarray(results)
-
-
-# from numba import njit, prange
-# @njit(parallel=True)
-# def circulant_inverse(circ):
-#     circ_inv = np.zeros_like(circ)
-#     for i in prange(0, M):
-#         circ_inv[i, :, :] = np.linalg.inv(np.identity(N) - (refInd**2 - 1) *
-#                                         circ[i, :, :])
-#     return circ_inv
-
-# circ_inv = circulant_inverse(circ)
+# Factorise preconditioner: LU factors of all blocks in one batched call
+circ_lu = circ2_factor(circ, refInd**2 - 1)
 end = time.time()
 print('Preconditioner assembly time = ', end - start)
 
 
-def mvp_circ(x, circ_inv, M, N, IDX):
+def mvp_circ(x, circ_lu, M, N, IDX):
     x_r = x
     # from IPython import embed; embed()
     x_r[np.invert(IDX)] = 0.0 
     x_rhs = x_r.reshape(M*N, 1, order='F')
 
     temp = x_rhs.reshape(M, N, order='F')
-    temp = np.fft.fft(temp, axis=0).T
-    for i in range(0, M):
-        temp[:, i] = np.matmul(circ_inv[i, :, :], temp[:, i])
+    temp = np.fft.fft(temp, axis=0)
+    temp = circ2_solve(circ_lu, temp)
 
-    temp = np.fft.ifft(temp.T, axis=0)
+    temp = np.fft.ifft(temp, axis=0)
     TEMP = temp.reshape(M*N, 1, order='F')
     TEMP_RO = TEMP
     TEMP_RO[np.invert(IDX)] = 0.0 + 0.0j
@@ -259,8 +231,8 @@ def mvp_circ(x, circ_inv, M, N, IDX):
     return matvec
 
 idx_all = np.ones((M*N, 1), dtype=bool)
-mvp_prec = lambda x: mvp_circ(x, circ_inv, M, N, IDX[:, 0])
-# mvp_prec = lambda x: mvp_circ(x, circ_inv, M, N, idx_all)
+mvp_prec = lambda x: mvp_circ(x, circ_lu, M, N, IDX[:, 0])
+# mvp_prec = lambda x: mvp_circ(x, circ_lu, M, N, idx_all)
 
 # circ_mat = np.zeros((M*N, M*N), dtype=np.complex128)
 # for i in range(0, M*N):
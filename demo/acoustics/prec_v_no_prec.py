@@ -108,24 +108,13 @@ circ2, circ_M_opToep = circ_2_level_acoustic(circ_L_opToep, L, M, N)
 end = time.time()
 print('Circulant preconditioner construction (s):', end-start)
 
-# Invert preconditioner in parallel
+# Eigendecomposition of the preconditioner blocks: this is independent of the
+# refractive index, so the inverse for any contrast is a diagonal scaling
 start = time.time()
-def processInput(i):
-    inverse_blocks = np.zeros((M, N, N), dtype=np.complex128)
-    for j in range(0, M):
-            inverse_blocks[j, :, :] = np.linalg.inv(np.identity(N) - (refInd**2 - 1) * circ2[i, j, :, :])
-    return inverse_blocks
-
-from joblib import Parallel, delayed  
-import multiprocessing
-inputs = range(L)
-
-num_cores = multiprocessing.cpu_count()
-
-print("numCores = " + str(num_cores))
-
-results = Parallel(n_jobs=num_cores)(delayed(processInput)(i) for i in inputs) 
-circ2_inv = np.asarray(results)
+from vines.precondition.circulant_acoustic import (circ2_eig_acoustic,
+                                                   circ2_inv_from_eig)
+circ2_eig = circ2_eig_acoustic(circ2)
+circ2_inv = circ2_inv_from_eig(circ2_eig, refInd**2 - 1)
 
 end = time.time()
 print('Preconditioner inversion (s):', end-start)
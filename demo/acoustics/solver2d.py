@@ -1,6 +1,8 @@
 import numpy as np
 from scipy.special import hankel1
 from scipy.linalg import toeplitz
+from vines.precondition.circulant_acoustic import (circ2_eig_acoustic,
+                                                   circ2_inv_from_eig)
 
 def geometry2d(h_temp, wx, wy):
     # FIXME: currently this allows dx and dy to differ. Just make the same size
@@ -68,7 +70,7 @@ def circulant_embedding(toep, M, N):
     return opCirc
 
 
-def circulant_preconditioner(toep, M, N, refInd):
+def circulant_blocks(toep, M, N):
     c = np.zeros((M, N), dtype=np.complex128)
 
     for i in range(1, M):
@@ -87,10 +89,19 @@ def circulant_preconditioner(toep, M, N, refInd):
                                 c_fft[i_loop, 0:N])
         circ[i_loop, :, :] = temp
 
-    # Invert preconditioner
-    circ_inv = np.zeros_like(circ)
-    for i in range(0, M):
-        circ_inv[i, :, :] = np.linalg.inv(np.identity(N) - (refInd**2 - 1) *
-                                        circ[i, :, :])
+    return circ
+
+
+def circulant_preconditioner_eig(toep, M, N):
+    # Eigendecomposition of the preconditioner blocks, independent of the
+    # refractive index
+    return circ2_eig_acoustic(circulant_blocks(toep, M, N))
+
 
-    return circ_inv
\ No newline at end of file
+def circulant_inverse(circ_eig, refInd):
+    # Invert preconditioner: a diagonal scaling in the eigenbasis
+    return circ2_inv_from_eig(circ_eig, refInd**2 - 1)
+
+
+def circulant_preconditioner(toep, M, N, refInd):
+    return circulant_inverse(circulant_preconditioner_eig(toep, M, N), refInd)
\ No newline at end of file
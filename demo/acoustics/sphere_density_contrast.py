@@ -18,7 +18,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
 import numpy as np
 from vines.geometry.geometry import shape
 from vines.fields.plane_wave import PlaneWave
-from vines.operators.acoustic_operators import volume_potential, grad_potential
+from vines.operators.acoustic_operators import volume_and_grad_potential
 from vines.precondition.threeD import circulant_embed_fftw, circulant_gradient_embed
 from vines.operators.acoustic_matvecs import (mvp_vec_fftw, mvp_domain,
     mvp_potential_x_perm, mvp_vec_rho_fftw, mvp_potential_grad)
@@ -84,13 +84,11 @@ from findiff import FinDiff, Gradient
 grad = Gradient(spac=[dx, dx, dx])
 Dr_grad = grad(Dr)
 
-# Assemble volume potential operator
-toep = volume_potential(ko, r)
+# Assemble volume potential operator and its gradient (these share the
+# same radial factors so are computed together)
+toep, toep_grad = volume_and_grad_potential(ko, r)
 toep = ko**2 * toep
 
-# Assemble gradient of volume potential operator
-toep_grad = grad_potential(ko, r)
-
 # Circulant embedding of volume potential operator
 circ_op = circulant_embed_fftw(toep, L, M, N)
 
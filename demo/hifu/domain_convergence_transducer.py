@@ -23,8 +23,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
 import numpy as np
 from vines.geometry.geometry import shape
 from vines.fields.plane_wave import PlaneWave
-from vines.operators.acoustic_operators import volume_potential
-from vines.precondition.threeD import circulant_embed_fftw
+from vines.operators.operator_cache import cached_operator
 from vines.operators.acoustic_matvecs import mvp_volume_potential, mvp_vec_fftw
 from scipy.sparse.linalg import LinearOperator, gmres
 from vines.mie_series_function import mie_function
@@ -236,10 +235,9 @@ for i_harm in range(1, n_harm):
     k2 = 2 * np.pi * f2 / c + 1j * attenuation(f2, alpha0, eta)
 
     # Assemble volume potential Toeplitz operator perform circulant embedding
+    # (loaded from the on-disk operator cache on repeated runs)
     start = time.time()
-    toep_op = volume_potential(k2, r)
-
-    circ_op = circulant_embed_fftw(toep_op, L, M, N)
+    circ_op = cached_operator('potential', k2, r)
     end = time.time()
     print('Operator assembly and its circulant embedding:', end-start)
 
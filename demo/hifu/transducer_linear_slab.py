@@ -189,7 +189,9 @@ Mr_box[idx_scat_box] = refInd**2 - 1
 
 '''         Solve scattering problem only over inhomogeneous region         '''
 # FIXME: come up with a better name for J
-sol, J, u_sca = vie_solver(Mr_box, r_box, idx_scat_box, P_inc[0][idx_scat], k1)
+# The slab is layered along x: precondition with blocks along x
+sol, J, u_sca = vie_solver(Mr_box, r_box, idx_scat_box, P_inc[0][idx_scat], k1,
+                           prec_axis=0)
 
 '''          Evaluate total field over total domain (u_inc + u_sca)         '''
 # Toeplitz operator
@@ -22,14 +22,14 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
 import numpy as np
 from vines.geometry.geometry import shape
 from vines.fields.plane_wave import PlaneWave
-from vines.operators.acoustic_operators import volume_potential
-from vines.precondition.threeD import circulant_embed_fftw
+from vines.operators.operator_cache import cached_operator
 from vines.operators.acoustic_matvecs import mvp_volume_potential, mvp_vec_fftw
 from scipy.sparse.linalg import LinearOperator, gmres
 from vines.mie_series_function import mie_function
 from matplotlib import pyplot as plt
 from vines.geometry.geometry import generatedomain
 from vines.fields.transducers import bowl_transducer, normalise_power
+from vines.fields.westervelt import westervelt_source, westervelt_coefficient
 import time
 import matplotlib
 from matplotlib import pyplot as plt
@@ -157,38 +157,18 @@ for i_harm in range(1, n_harm):
     k2 = 2 * np.pi * f2 / c + 1j * attenuation(f2, alpha0, eta)
 
     # Assemble volume potential Toeplitz operator perform circulant embedding
+    # (loaded from the on-disk operator cache on repeated runs)
     start = time.time()
-    toep_op = volume_potential(k2, r)
-
-    circ_op = circulant_embed_fftw(toep_op, L, M, N)
+    circ_op = cached_operator('potential', k2, r)
     end = time.time()
     print('Operator assembly and its circulant embedding:', end-start)
 
-    # Create vector for matrix-vector product
-    if i_harm == 1:
-        # Second harmonic
-        xIn = -2 * beta * omega**2 / (rho * c**4) * P[0] * P[0]
-    elif i_harm == 2:
-        # Third harmonic
-        xIn = -9 * beta * omega**2 / (rho * c**4) * P[0] * P[1]
-    elif i_harm == 3:
-        # Fourth harmonic
-        xIn = -8 * beta * omega**2 / (rho * c**4) * \
-            (P[1] * P[1] + 2 * P[0] * P[2])
-    elif i_harm == 4:
-        # Fifth harmonic
-        xIn = -25 * beta * omega**2 / (rho * c**4) * \
-            (P[0] * P[3] + P[1] * P[2])
-    elif i_harm == 5:
-        # Sixth harmonic
-        xIn = -18 * beta * omega**2 / (rho * c**4) * \
-            (2 * P[0] * P[4] + 2 * P[1] * P[3] + P[2]**2)
-    elif i_harm == 6:
-        # Seventh harmonic
-        xIn = -49 * beta * omega**2 / (rho * c**4) * \
-            (P[0] * P[5] + P[1] * P[4] + P[2] * P[3])
-
-    xInVec = xIn.reshape((L*M*N, 1), order='F')
+    # Create vector for matrix-vector product: the Westervelt source of
+    # this harmonic from all lower ones, written straight into it
+    xInVec = np.empty((L*M*N, 1), dtype=np.complex128)
+    westervelt_source(P[0:i_harm], i_harm + 1,
+                      westervelt_coefficient(beta, omega, rho, c),
+                      out=xInVec.reshape(L, M, N, order='F'))
     idx = np.ones((L, M, N), dtype=bool)
 
     def mvp(x):
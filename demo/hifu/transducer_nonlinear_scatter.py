@@ -22,15 +22,12 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
 import numpy as np
 from vines.geometry.geometry import shape
 from vines.fields.plane_wave import PlaneWave
-from vines.operators.acoustic_operators import volume_potential
-from vines.precondition.threeD import circulant_embed_fftw
-from vines.operators.acoustic_matvecs import mvp_volume_potential, mvp_vec_fftw, mvp_potential_x_perm
-from scipy.sparse.linalg import LinearOperator, gmres
+from vines.solvers.nested_scattering import NestedScatteringSolver
 from vines.mie_series_function import mie_function
 from matplotlib import pyplot as plt
-from vines.geometry.geometry import generatedomain, grid3d
+from vines.geometry.geometry import generatedomain
 from vines.fields.transducers import bowl_transducer, normalise_power
-from vie_solve import vie_solver
+from vines.fields.westervelt import westervelt_source, westervelt_coefficient
 import time
 import matplotlib
 from matplotlib import pyplot as plt
@@ -136,56 +133,22 @@ r_sq = (r[:, :, :, 0] - location[0])**2 + (r[:, :, :, 1] - location[1])**2 + \
     (r[:, :, :, 2] - location[2])**2
 idx_scat = (r_sq <= radius**2)
 
-xd, yd, zd = r[:, :, :, 0], r[:, :, :, 1], r[:, :, :, 2]
-# Find indices of bounding box of scatterer
-idx_box = (xd <= max(xd[idx_scat]) + 1e-6) * \
-          (xd >= min(xd[idx_scat]) - 1e-6) * \
-          (yd <= max(yd[idx_scat]) + 1e-6) * \
-          (yd >= min(yd[idx_scat]) - 1e-6) * \
-          (zd <= max(zd[idx_scat]) + 1e-6) * \
-          (zd >= min(zd[idx_scat]) - 1e-6)
-
-x_box = np.arange(min(xd[idx_scat]), max(xd[idx_scat]) + 1e-6, dx)
-y_box = np.arange(min(yd[idx_scat]), max(yd[idx_scat]) + 1e-6, dx)
-z_box = np.arange(min(zd[idx_scat]), max(zd[idx_scat]) + 1e-6, dx)
-
-r_box, L_box, M_box, N_box = grid3d(x_box, y_box, z_box)
-
-r_sq_box = (r_box[:, :, :, 0] - location[0])**2 + \
-    (r_box[:, :, :, 1] - location[1])**2 + \
-    (r_box[:, :, :, 2] - location[2])**2
-idx_scat_box = (r_sq_box <= radius**2)
-
-# Voxel permittivities
-Mr_box = np.zeros((L_box, M_box, N_box), dtype=np.complex128)
-Mr_box[idx_scat_box] = refInd**2 - 1
-
-'''         Solve scattering problem only over inhomogeneous region         '''
-# FIXME: come up with a better name for J
-sol, J, u_sca = vie_solver(Mr_box, r_box, idx_scat_box, P_inc[0][idx_scat], k1)
-
-'''          Evaluate total field over total domain (u_inc + u_sca)         '''
-# Toeplitz operator
-T = k1**2 * volume_potential(k1, r)
-
-# Circulant embedding of Toeplitz operator
-circ = circulant_embed_fftw(T, L, M, N)
-
 # Voxel permittivities
 Mr = np.zeros((L, M, N), dtype=np.complex128)
 Mr[idx_scat] = refInd**2 - 1
-# Mr[idx_box] = Mr_box.reshape((L_box*M_box*N_box, 1), order='F')[:, 0]
 
-J_domain = np.zeros((L, M, N), dtype=np.complex128)
-J_domain[idx_box] = J.reshape((L_box*M_box*N_box, 1))[:, 0]
+# The VIE is solved only over the scatterer's bounding box. The solver
+# holds, per wavenumber, one circulant spectrum of the whole domain (used
+# both for the incident harmonics and, scaled by k**2 Mr at matvec time,
+# for the scattered field) and the box operator
+solver = NestedScatteringSolver(r, Mr, idx_scat)
 
-# Evaluate at all voxels
-idx_all = np.ones((L, M, N), dtype=bool)
-
-P_sca[0] = mvp_potential_x_perm(J_domain.reshape((L*M*N, 1), order='F'),
-                                circ, idx_all, Mr).reshape(L, M, N, order='F')
-
-P[0] = P_inc[0] + P_sca[0]
+'''      Solve over the scatterer's box, total field over the domain        '''
+start = time.time()
+P[0], P_sca[0] = solver.solve(k1, P_inc[0])
+end = time.time()
+print('Scattering solve ({0} iterations) and evaluation time (s):'.format(
+    solver.iterations), end-start)
 
 
 ny_centre = np.int(np.floor(M/2))
@@ -200,65 +163,26 @@ for i_harm in range(1, n_harm):
     f2 = (i_harm + 1) * f1
     k2 = 2 * np.pi * f2 / c + 1j * attenuation(f2, alpha0, eta)
 
-    # Assemble volume potential Toeplitz operator perform circulant embedding
-    start = time.time()
-    toep_op = volume_potential(k2, r)
+    # Create vector for matrix-vector product: the Westervelt source of
+    # this harmonic from all lower ones, written straight into it
+    xInVec = np.empty((L*M*N, 1), dtype=np.complex128)
+    westervelt_source(P[0:i_harm], i_harm + 1,
+                      westervelt_coefficient(beta, omega, rho, c),
+                      out=xInVec.reshape(L, M, N, order='F'))
 
-    circ_op = circulant_embed_fftw(toep_op, L, M, N)
-    end = time.time()
-    print('Operator assembly and its circulant embedding:', end-start)
-
-    # Create vector for matrix-vector product
-    if i_harm == 1:
-        # Second harmonic
-        xIn = -2 * beta * omega**2 / (rho * c**4) * P[0] * P[0]
-    elif i_harm == 2:
-        # Third harmonic
-        xIn = -9 * beta * omega**2 / (rho * c**4) * P[0] * P[1]
-    elif i_harm == 3:
-        # Fourth harmonic
-        xIn = -8 * beta * omega**2 / (rho * c**4) * \
-            (P[1] * P[1] + 2 * P[0] * P[2])
-    elif i_harm == 4:
-        # Fifth harmonic
-        xIn = -25 * beta * omega**2 / (rho * c**4) * \
-            (P[0] * P[3] + P[1] * P[2])
-
-    xInVec = xIn.reshape((L*M*N, 1), order='F')
-    idx_all = np.ones((L, M, N), dtype=bool)
-
-    # def mvp(x):
-    #     'Matrix-vector product operator'
-    #     return mvp_volume_potential(x, circ_op, idx, Mr)
-
-    # Voxel permittivities for volume potential (all ones)
-    Mr_vol_pot = np.ones((L, M, N), dtype=np.complex128)
-
-    # Perform matrix-vector product
+    # Incident harmonic (the operators for k2 are assembled here, or
+    # loaded from the operator cache, and reused by the solve below)
     start = time.time()
-    # P_inc[i_harm] = mvp(xInVec).reshape(L, M, N, order='F')
-    P_inc[i_harm] = mvp_volume_potential(xInVec, circ_op, idx_all, Mr_vol_pot).reshape(L, M, N, order='F')
-
-    # from IPython import embed; embed()
-
-    # Solve scattering problem
-    sol, J, u_sca = vie_solver(Mr_box, r_box, idx_scat_box,
-                               P_inc[i_harm][idx_scat], k2)
-
-    # Evaluate scattered field in total domain
-    # Toeplitz operator
-    T = k2**2 * volume_potential(k2, r)
-
-    # Circulant embedding of Toeplitz operator
-    circ = circulant_embed_fftw(T, L, M, N)
-
-    J_domain = np.zeros((L, M, N), dtype=np.complex128)
-    J_domain[idx_box] = J.reshape((L_box*M_box*N_box, 1))[:, 0]
-
-    P_sca[i_harm] = mvp_potential_x_perm(J_domain.reshape((L*M*N, 1), order='F'),
-                                    circ, idx_all, Mr).reshape(L, M, N, order='F')
+    P_inc[i_harm] = solver.volume_potential(k2, xInVec)
+    end = time.time()
+    print('Operator assembly and volume potential evaluation:', end-start)
 
-    P[i_harm] = P_inc[i_harm] + P_sca[i_harm]
+    # Solve scattering problem and evaluate the total field in the domain
+    start = time.time()
+    P[i_harm], P_sca[i_harm] = solver.solve(k2, P_inc[i_harm])
+    end = time.time()
+    print('Scattering solve ({0} iterations) and evaluation time (s):'.format(
+        solver.iterations), end-start)
 
 
 
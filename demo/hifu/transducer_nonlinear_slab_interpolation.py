@@ -31,6 +31,7 @@ from vines.mie_series_function import mie_function
 from matplotlib import pyplot as plt
 from vines.geometry.geometry import generatedomain, grid3d
 from vines.fields.transducers import bowl_transducer_rotate, normalise_power_rotate
+from vines.fields.westervelt import westervelt_source, westervelt_coefficient
 from vie_solve import vie_solver
 import time
 import matplotlib
@@ -200,7 +201,9 @@ Mr_box[idx_scat_box] = refInd**2 - 1
 
 '''         Solve scattering problem only over inhomogeneous region         '''
 # FIXME: come up with a better name for J
-sol, J, u_sca = vie_solver(Mr_box, r_box, idx_scat_box, P_inc[0][idx_scat], k1)
+# The slab is layered along x: precondition with blocks along x
+sol, J, u_sca = vie_solver(Mr_box, r_box, idx_scat_box, P_inc[0][idx_scat], k1,
+                           prec_axis=0)
 
 '''          Evaluate total field over total domain (u_inc + u_sca)         '''
 # Toeplitz operator
@@ -354,23 +357,12 @@ for i_harm in range(1, n_harm):
     end = time.time()
     print('Operator assembly and its circulant embedding:', end-start)
 
-    # Create vector for matrix-vector product
-    if i_harm == 1:
-        # Second harmonic
-        xIn = -2 * BETA * omega**2 / (RHO * C**4) * P[0] * P[0]
-    elif i_harm == 2:
-        # Third harmonic
-        xIn = -9 * BETA * omega**2 / (RHO * C**4) * P[0] * P[1]
-    elif i_harm == 3:
-        # Fourth harmonic
-        xIn = -8 * BETA * omega**2 / (RHO * C**4) * \
-            (P[1] * P[1] + 2 * P[0] * P[2])
-    elif i_harm == 4:
-        # Fifth harmonic
-        xIn = -25 * BETA * omega**2 / (RHO * C**4) * \
-            (P[0] * P[3] + P[1] * P[2])
-
-    xInVec = xIn.reshape((L*M*N, 1), order='F')
+    # Create vector for matrix-vector product: the Westervelt source of
+    # this harmonic from all lower ones, written straight into it
+    xInVec = np.empty((L*M*N, 1), dtype=np.complex128)
+    westervelt_source(P[0:i_harm], i_harm + 1,
+                      westervelt_coefficient(BETA, omega, RHO, C),
+                      out=xInVec.reshape(L, M, N, order='F'))
     idx_all = np.ones((L, M, N), dtype=bool)
 
     # def mvp(x):
@@ -392,7 +384,7 @@ for i_harm in range(1, n_harm):
 
     # Solve scattering problem
     sol, J, u_sca = vie_solver(Mr_box, r_box, idx_scat_box,
-                               P_inc[i_harm][idx_scat], k2)
+                               P_inc[i_harm][idx_scat], k2, prec_axis=0)
 
     # Evaluate scattered field in total domain
     # Toeplitz operator
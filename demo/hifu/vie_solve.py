@@ -4,9 +4,17 @@
 #
 # 1. Assemble Toeplitz integral operator, T, over the scatterer's bounding box
 # 2. Embed Toeplitz operator, T, in a circulant operator and take FFT
+#    (steps 1 and 2 are skipped when the spectrum is in the operator cache)
 # 3. Set up a matrix-vector product function (I - M*T)
-# 4. Set up the iterative solver (GMRES, BiCGStab,...)
-# 5. Perform iterative solve
+# 4. Optionally, set up a 2-level circulant preconditioner built from the
+#    contrast profile of Mr along prec_axis (for layered/inhomogeneous media)
+# 5. Set up the iterative solver (GMRES, BiCGStab,...)
+# 6. Perform iterative solve
+#
+# Steps 1-3 are done by vines.solvers.vie_solver.VIESolver, which can be
+# kept and reused for further media and incident fields at the same
+# wavenumber and grid (see vie_solver_engine below). Only the most recent
+# solver is kept, so harmonic loops hold one operator at a time.
 
 # Inputs required:
 #
@@ -15,58 +23,41 @@
 # 3. idx - indices of scatter voxels (True if in scatterer, False if not)
 # 4. k - wavenumber
 # 5. u_inc - incident field evaluated over voxel grid
+# 6. prec_axis - axis of the preconditioner blocks (None: no preconditioner)
 
-import numpy as np
-from vines.operators.acoustic_operators import volume_potential
-from vines.operators.acoustic_matvecs import mvp_vec_fftw, mvp_potential_x_perm
-from scipy.sparse.linalg import LinearOperator, gmres
-from vines.precondition.threeD import circulant_embed_fftw
-from scipy.sparse.linalg import LinearOperator, gmres
+from vines.solvers.vie_solver import VIESolver
+from vines.operators.operator_cache import grid_spacing
 import time
 
+# Holds at most one solver (the most recent)
+_engines = {}
 
-def vie_solver(Mr, r, idx, u_inc, k):
-    # Toeplitz operator
-    T = k**2 * volume_potential(k, r)
-
-    # Get shape of voxel grid
-    (L, M, N, _) = r.shape
-    n_voxel = L * M * N
-
-    # Circulant embedding of Toeplitz operator
-    circ = circulant_embed_fftw(T, L, M, N)
-
-    # Create array that has the incident field values inside scatterer
-    xIn = np.zeros((L, M, N), dtype=np.complex128)
-    xIn[idx] = u_inc
-    xInVec = xIn.reshape((n_voxel, 1), order='F')
 
-    def mvp(x):
-        'Matrix-vector product operator'
-        return mvp_vec_fftw(x, circ, idx, Mr)
+def vie_solver_engine(r, k, prec_axis=None):
+    'Solver for wavenumber k on grid r, reused while k and r stay the same'
+    key = (complex(k), grid_spacing(r), r.shape, prec_axis)
+    if key not in _engines:
+        # Release the previous solver before assembling the new one
+        _engines.clear()
+        _engines[key] = VIESolver(k, r, prec_axis=prec_axis)
+    return _engines[key]
 
-    # Linear operator
-    A = LinearOperator((n_voxel, n_voxel), matvec=mvp)
 
-    def residual_vector(rk):
-        'Function to store residual vector in iterative solve'
-        # global resvec
-        resvec.append(rk)
+def vie_solver(Mr, r, idx, u_inc, k, prec_axis=None):
+    solver = vie_solver_engine(r, k, prec_axis)
+    solver.set_medium(Mr, idx)
 
-    # Iterative solve with GMRES (could equally use BiCG-Stab, for example)
+    # Iterative solve with GMRES (with Krylov subspace recycling)
     start = time.time()
-    resvec = []
-    sol, info = gmres(A, xInVec, tol=1e-4, callback=residual_vector)
-    print("The linear system was solved in {0} iterations".format(len(resvec)))
+    J = solver.solve(u_inc)
+    print("The linear system was solved in {0} iterations".format(
+        len(solver.resvec)))
     end = time.time()
     print('Solve time = ', end-start, 's')
 
-    # Reshape solution
-    J = sol.reshape(L, M, N, order='F')
+    sol = J.reshape(-1, order='F')
 
     # Evaluate scattered field in domain using representation formula
-    idx_all = np.ones((L, M, N), dtype=bool)
-    u_sca = mvp_potential_x_perm(sol, circ, idx_all,
-                                 Mr).reshape(L, M, N, order='F')
+    u_sca = solver.scattered_field()
 
     return sol, J, u_sca
@@ -15,3 +15,18 @@ def PlaneWave(Uo, k, dInc, r):
     Uinc = Uo * expKr
 
     return Uinc
+
+
+def PlaneWaves(Uo, k, dInc, r):
+    ''' Block of plane waves, one per row of dInc (n_rhs, 3), returned as
+    (L, M, N, n_rhs). Uo is a scalar or one amplitude per direction. '''
+    import numpy as np
+
+    dInc = np.atleast_2d(dInc)
+    Uo = np.broadcast_to(Uo, (dInc.shape[0],))
+
+    kr = k * np.einsum('lmnd,pd->lmnp', r, dInc)
+
+    Uinc = Uo * np.exp(1j * kr)
+
+    return Uinc
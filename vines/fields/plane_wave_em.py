@@ -16,4 +16,21 @@ def PlaneWaveEM(Eo, kvec, r):
     Einc[:, :, :, 1] = Eo[1] * expKr
     Einc[:, :, :, 2] = Eo[2] * expKr
     
-    return Einc
\ No newline at end of file
+    return Einc
+
+
+def PlaneWavesEM(Eo, kvec, r):
+    ''' Block of plane waves with polarisations Eo (n_rhs, 3) and wave
+    vectors kvec (n_rhs, 3), returned as (L, M, N, 3, n_rhs) '''
+    import numpy as np
+
+    Eo = np.atleast_2d(Eo)
+    kvec = np.atleast_2d(kvec)
+
+    kr = np.einsum('lmnd,pd->lmnp', r, kvec)
+
+    expKr = np.exp(1j * kr)
+
+    Einc = expKr[:, :, :, None, :] * Eo.T
+
+    return Einc
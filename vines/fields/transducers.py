@@ -290,3 +290,24 @@ def normalise_power_rotate(power, rho, c0, radius, k1, focal_length,
     integral = 2*np.pi*np.sum(np.abs(p_quad)**2 * r_quad)*r_quad_dim/n_quad 
     p0 = np.sqrt(2*rho*c0*power/integral)
     return p0
+
+
+def bowl_field(k, rho, c0, focal_length, radius, aperture_radius, power,
+               r, n_elements=2**12):
+    ''' Field of a bowl transducer focused along the x-axis, with its
+    focus at (focal_length, 0, 0), on the voxel grid r (L, M, N, 3),
+    normalised to the given total acoustic power. Voxels within 0.5 mm of
+    the bowl's surface, where the point-source sum is singular, are set
+    to zero. '''
+    import numpy as np
+    (L, M, N, _) = r.shape
+    focus = [focal_length, 0., 0.]
+    points = r.reshape(L*M*N, 3, order='F')
+    _, _, _, p = bowl_transducer(k, focal_length, focus, radius, n_elements,
+                                 aperture_radius, points.T, 'x')
+    dist_from_focus = np.sqrt((points[:, 0]-focus[0])**2 + points[:, 1]**2 +
+                              points[:, 2]**2)
+    p[np.abs(dist_from_focus - focal_length) < 5e-4] = 0.0
+    p *= normalise_power(power, rho, c0, radius, k, focal_length, focus,
+                         n_elements, aperture_radius)
+    return p.reshape(L, M, N, order='F')
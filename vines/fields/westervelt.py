@@ -0,0 +1,58 @@
+# Quadratic Westervelt source terms for harmonic cascades
+#
+# With p = sum_n Re(P_n exp(-i n omega t)), the quadratic term of the
+# Westervelt equation drives harmonic n through all pairs of lower
+# harmonics whose frequencies add up to n omega:
+#
+#     S_n = -beta n^2 omega^2 / (2 rho c^4) sum_{m=1}^{n-1} P_m P_{n-m}
+#
+# (e.g. -2 beta omega^2 / (rho c^4) P_1^2 for the second harmonic). The
+# sum is evaluated in one pass over the grid per harmonic, pairing
+# P_m P_{n-m} with P_{n-m} P_m, and written straight into the caller's
+# buffer (typically the matvec input vector), so any number of harmonics
+# costs the same per harmonic.
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def westervelt_kernel(P, n, coeff, out):
+    ''' out = -n^2 / 2 * coeff * sum_{m=1}^{n-1} P_m P_{n-m}, where P[m-1]
+    holds harmonic m '''
+    (L, M, N) = out.shape
+    for i in prange(0, L):
+        for j in range(0, M):
+            for k in range(0, N):
+                s = 0.0j
+                for m in range(0, (n - 1) // 2):
+                    s += P[m, i, j, k] * P[n - 2 - m, i, j, k]
+                s *= 2.0
+                if n % 2 == 0:
+                    s += P[n // 2 - 1, i, j, k] * P[n // 2 - 1, i, j, k]
+                out[i, j, k] = -0.5 * n * n * coeff[i, j, k] * s
+
+
+def westervelt_coefficient(beta, omega, rho, c):
+    ''' beta omega^2 / (rho c^4), for scalar or voxelwise medium
+    parameters (omega is the fundamental angular frequency) '''
+    return beta * omega**2 / (rho * c**4)
+
+
+def westervelt_source(P, n, coeff, out=None):
+    ''' Source term of harmonic n >= 2 from the fields of harmonics 1 to
+    n - 1, P[0:n-1] (a (n_harm, L, M, N) array, or a list of (L, M, N)
+    arrays), with coeff = westervelt_coefficient(...) a scalar or an
+    (L, M, N) array. out may be any (L, M, N) view, e.g.
+    xInVec.reshape(L, M, N, order='F'); it is returned. '''
+    if n < 2:
+        raise ValueError('Harmonic sources start at n = 2')
+    if isinstance(P, (list, tuple)):
+        P = np.stack(P[0:n - 1])
+    P = np.asarray(P, dtype=np.complex128)[0:n - 1]
+    shape = P.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=np.complex128, order='F')
+    coeff = np.broadcast_to(np.asarray(coeff, dtype=np.complex128), shape)
+    westervelt_kernel(P, n, coeff, out)
+    return out
@@ -0,0 +1,168 @@
+# Resampling between uniform, axis-aligned voxel grids
+#
+# Transferring a field from one grid to another (e.g. earlier harmonics
+# onto the next, finer grid of a nested-mesh run) only needs each grid's
+# origin and spacing: along every axis the target samples map to
+# fractional source indices, so the stencil indices and weights are 1-D
+# tables computed once per axis, and a parallel Numba kernel combines
+# them. No coordinate arrays or point searches are involved.
+#
+# method='linear'  trilinear interpolation
+# method='cubic'   tricubic (Keys cubic convolution, a = -1/2)
+# method='fft'     band-limited: trigonometric interpolation along each
+#                  axis via FFT zero-padding/truncation, for grids whose
+#                  spacings have a rational ratio (as for harmonics)
+#
+# Target points outside the source grid are set to zero.
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def separable_kernel(src, ix, wx, iy, wy, iz, wz, out):
+    ''' out[i, j, k] = sum_abc wx[i, a] wy[j, b] wz[k, c]
+    src[ix[i, a], iy[j, b], iz[k, c]]. Loops run fastest along the first
+    axis, suiting the Fortran-ordered fields of the matvecs. '''
+    (L, M, N) = out.shape
+    S = wx.shape[1]
+    for k in prange(0, N):
+        for j in range(0, M):
+            for i in range(0, L):
+                s = 0.0j
+                for c in range(0, S):
+                    if wz[k, c] == 0.0:
+                        continue
+                    for b in range(0, S):
+                        wbc = wy[j, b] * wz[k, c]
+                        if wbc == 0.0:
+                            continue
+                        for a in range(0, S):
+                            s += wx[i, a] * wbc * \
+                                src[ix[i, a], iy[j, b], iz[k, c]]
+                out[i, j, k] = s
+
+
+def _positions(n_src, o_src, h_src, n_dst, o_dst, h_dst):
+    ''' Fractional source indices of the target samples along one axis,
+    and which of them lie inside the source grid '''
+    x = (o_dst + h_dst * np.arange(0, n_dst) - o_src) / h_src
+    tol = 1e-9 * max(n_src, 1)
+    inside = (x >= -tol) & (x <= n_src - 1 + tol)
+    return np.clip(x, 0, n_src - 1), inside
+
+
+def stencil_linear(n_src, o_src, h_src, n_dst, o_dst, h_dst):
+    ''' Indices and weights (n_dst, 2) of linear interpolation '''
+    x, inside = _positions(n_src, o_src, h_src, n_dst, o_dst, h_dst)
+    i0 = np.minimum(np.floor(x).astype(np.int64), max(n_src - 2, 0))
+    t = x - i0
+    idx = np.stack((i0, np.minimum(i0 + 1, n_src - 1)), axis=1)
+    w = np.stack((1 - t, t), axis=1) * inside[:, None]
+    return idx, w
+
+
+def stencil_cubic(n_src, o_src, h_src, n_dst, o_dst, h_dst):
+    ''' Indices and weights (n_dst, 4) of Keys cubic convolution, with the
+    end samples repeated beyond the grid '''
+    x, inside = _positions(n_src, o_src, h_src, n_dst, o_dst, h_dst)
+    i0 = np.floor(x).astype(np.int64)
+    t = x - i0
+    idx = np.clip(i0[:, None] + np.arange(-1, 3)[None, :], 0, n_src - 1)
+    t2 = t * t
+    t3 = t2 * t
+    w = np.stack((-0.5 * t3 + t2 - 0.5 * t,
+                  1.5 * t3 - 2.5 * t2 + 1,
+                  -1.5 * t3 + 2 * t2 + 0.5 * t,
+                  0.5 * t3 - 0.5 * t2), axis=1) * inside[:, None]
+    return idx, w
+
+
+def _fft_resample_axis(a, axis, o_src, h_src, n_dst, o_dst, h_dst):
+    ''' Band-limited resampling of a along one axis. The source is
+    zero-padded to the shortest length n_p whose period n_p h_src holds a
+    whole number n_f of target spacings; its spectrum is then padded or
+    truncated to n_f, shifted by the sub-sample offset of the target
+    origin and transformed back. '''
+    n_src = a.shape[axis]
+    ratio = h_src / h_dst
+    for n_p in range(n_src, 3 * n_src + 1):
+        n_f = int(np.round(n_p * ratio))
+        if n_f > 0 and abs(n_f - n_p * ratio) < 1e-6 * n_f:
+            break
+    else:
+        raise ValueError('Grid spacings {0} and {1} are not commensurate'
+                         .format(h_src, h_dst))
+    a = np.moveaxis(a, axis, 0)
+    A = np.fft.fft(a, n_p, axis=0)
+    B = np.zeros((n_f,) + A.shape[1:], dtype=np.complex128)
+    # Copy the frequencies common to both lengths; an even-length Nyquist
+    # term is split between +/- when padding and folded when truncating
+    n = min(n_p, n_f)
+    nyq = n // 2 + 1
+    B[0:nyq] = A[0:nyq]
+    if n > 2:
+        B[n_f - (n - nyq):] = A[n_p - (n - nyq):]
+    if n % 2 == 0:
+        if n_f < n_p:
+            B[n // 2] += A[n_p - n // 2]
+        elif n_p < n_f:
+            B[n // 2] *= 0.5
+            B[n_f - n // 2] = B[n // 2]
+    # Shift by the fractional part of the target origin (in target
+    # samples) and keep the target window of the fine periodic grid
+    s = (o_dst - o_src) / h_dst
+    q0 = int(np.floor(s + 1e-9))
+    phase = np.exp(2j * np.pi * np.fft.fftfreq(n_f) * (s - q0))
+    B *= phase.reshape((n_f,) + (1,) * (A.ndim - 1))
+    b = np.fft.ifft(B, axis=0)[(q0 + np.arange(0, n_dst)) % n_f]
+    b *= n_f / n_p
+    _, inside = _positions(n_src, o_src, h_src, n_dst, o_dst, h_dst)
+    b *= inside.reshape((n_dst,) + (1,) * (A.ndim - 1))
+    return np.moveaxis(b, 0, axis)
+
+
+def resample(src, origin, spacing, origin_out, spacing_out, shape_out,
+             out=None, method='linear'):
+    ''' Resample src, given on the uniform grid with origin (first voxel
+    centre) and spacing (3-sequences, or a scalar spacing), onto the
+    uniform grid with origin_out, spacing_out and shape_out. The result is
+    written into out (e.g. a preallocated Fortran-ordered complex array)
+    when given, and returned. '''
+    origin = np.broadcast_to(np.asarray(origin, dtype=np.float64), (3,))
+    origin_out = np.broadcast_to(np.asarray(origin_out, dtype=np.float64),
+                                 (3,))
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=np.float64), (3,))
+    spacing_out = np.broadcast_to(np.asarray(spacing_out, dtype=np.float64),
+                                  (3,))
+    if out is None:
+        out = np.empty(shape_out, dtype=np.complex128, order='F')
+
+    if method in ('linear', 'cubic'):
+        stencil = stencil_linear if method == 'linear' else stencil_cubic
+        tables = []
+        for d in range(0, 3):
+            tables += stencil(src.shape[d], origin[d], spacing[d],
+                              shape_out[d], origin_out[d], spacing_out[d])
+        separable_kernel(np.asarray(src, dtype=np.complex128), *tables, out)
+    elif method == 'fft':
+        a = src
+        for d in range(0, 3):
+            a = _fft_resample_axis(a, d, origin[d], spacing[d],
+                                   shape_out[d], origin_out[d],
+                                   spacing_out[d])
+        out[:] = a
+    else:
+        raise ValueError("method must be 'linear', 'cubic' or 'fft'")
+    return out
+
+
+def resample_axes(src, axes, axes_out, out=None, method='linear'):
+    ''' resample between grids given by their (x, y, z) axes '''
+    def grid(axes):
+        origin = [a[0] for a in axes]
+        spacing = [a[1] - a[0] if a.size > 1 else 1.0 for a in axes]
+        return origin, spacing, tuple(a.size for a in axes)
+    (o, h, _) = grid(axes)
+    (o2, h2, shape) = grid(axes_out)
+    return resample(src, o, h, o2, h2, shape, out, method)
@@ -1,9 +1,41 @@
 import pyfftw
-import multiprocessing
 import numpy as np
-# Configure PyFFTW to use all cores (the default is single-threaded)
-pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
-pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
+from vines.operators.fftw_wisdom import configure
+from vines.operators.pruned_fft import pruned_fftn, pruned_ifftn, PrunedFFT
+# Configure PyFFTW to use all cores (the default is single-threaded) and
+# reuse the FFTW wisdom stored by earlier runs
+configure()
+
+
+def circulant_multiply(circ_op, xFFT):
+    ''' In-place product of xFFT, shape (2L, 2M, 2N), with the circulant
+    spectrum. circ_op is either the full spectrum or its octant-compressed
+    (L+1, M+1, N+1) form, which is mirrored slab by slab without expanding
+    it. Leading axes of xFFT (e.g. a block of right-hand sides) share the
+    same spectrum. '''
+    if circ_op.shape == xFFT.shape[-3:]:
+        if xFFT.ndim == 3:
+            xFFT *= circ_op
+        else:
+            # Apply each slab of the spectrum to all columns while it is
+            # in cache
+            for i in range(0, circ_op.shape[0]):
+                xFFT[..., i, :, :] *= circ_op[i]
+        return xFFT
+    (L, M, N) = [n // 2 for n in xFFT.shape[-3:]]
+    sx = ((slice(0, L + 1), slice(0, L + 1)),
+          (slice(L + 1, 2 * L), slice(L - 1, 0, -1)))
+    sy = ((slice(0, M + 1), slice(0, M + 1)),
+          (slice(M + 1, 2 * M), slice(M - 1, 0, -1)))
+    sz = ((slice(0, N + 1), slice(0, N + 1)),
+          (slice(N + 1, 2 * N), slice(N - 1, 0, -1)))
+    for (ox, cx) in sx:
+        for (oy, cy) in sy:
+            for (oz, cz) in sz:
+                xFFT[..., ox, oy, oz] *= circ_op[cx, cy, cz]
+    return xFFT
+
+
 def mvp_vec_fftw(xIn, circ_op, idx, Mr):
     ''' Matrix-vector product with FFTW'''
     (L, M, N) = Mr.shape
@@ -13,8 +45,9 @@ def mvp_vec_fftw(xIn, circ_op, idx, Mr):
     xOut = np.zeros((L, M, N), dtype=np.complex128)
     xOutVec = np.zeros((L * M * N, 1), dtype=np.complex128)
 
-    xFFT = pyfftw.interfaces.numpy_fft.fftn(xInRO, [2 * L, 2 * M, 2 * N])
-    Y = pyfftw.interfaces.numpy_fft.ifftn(circ_op * xFFT)
+    xFFT = pruned_fftn(xInRO, [2 * L, 2 * M, 2 * N])
+    Y = pruned_ifftn(circulant_multiply(circ_op, xFFT), [L, M, N],
+                     overwrite_input=True)
     xPerm = Mr * Y[0:L, 0:M, 0:N]
     xOut = xInRO - xPerm
     xOut[np.invert(idx)] = 0.0
@@ -22,6 +55,35 @@ def mvp_vec_fftw(xIn, circ_op, idx, Mr):
     return xOutVec
 
 
+def mvp_vec_fftw_block(xIn, circ_op, idx, Mr, chunk=None):
+    ''' Matrix-vector product with FFTW for a block of right-hand sides,
+    xIn of shape (L*M*N, n_rhs). The FFTs of a chunk of columns run as one
+    batched transform and each slab of the spectrum is applied to all of
+    them while it is in cache. chunk bounds the number of columns
+    transformed together (the padded spectra take 128 L*M*N bytes per
+    column). '''
+    (L, M, N) = Mr.shape
+    n_rhs = xIn.shape[1]
+    chunk = n_rhs if chunk is None else chunk
+    xInRO = xIn.reshape(L, M, N, n_rhs, order='F')
+    xInRO[np.invert(idx)] = 0.0
+
+    xOutVec = np.zeros((L * M * N, n_rhs), dtype=np.complex128)
+    xOut = xOutVec.reshape(L, M, N, n_rhs, order='F')
+
+    for j in range(0, n_rhs, chunk):
+        cols = slice(j, min(j + chunk, n_rhs))
+        # Columns first, so that each one is a contiguous 3-D transform
+        xFFT = pruned_fftn(np.moveaxis(xInRO[:, :, :, cols], 3, 0),
+                           [2 * L, 2 * M, 2 * N], axes=(1, 2, 3))
+        Y = pruned_ifftn(circulant_multiply(circ_op, xFFT), [L, M, N],
+                         axes=(1, 2, 3), overwrite_input=True)
+        xOut[:, :, :, cols] = xInRO[:, :, :, cols] - \
+            Mr[:, :, :, None] * np.moveaxis(Y, 0, 3)
+    xOut[np.invert(idx)] = 0.0
+    return xOutVec
+
+
 def mvp_vec_test(xIn, circ_op, rho_ratio, idx, Mr):
     ''' Matrix-vector product with FFTW'''
     (L, M, N) = Mr.shape
@@ -31,8 +93,9 @@ def mvp_vec_test(xIn, circ_op, rho_ratio, idx, Mr):
     xOut = np.zeros((L, M, N), dtype=np.complex128)
     xOutVec = np.zeros((L * M * N, 1), dtype=np.complex128)
 
-    xFFT = pyfftw.interfaces.numpy_fft.fftn(xInRO, [2 * L, 2 * M, 2 * N])
-    Y = pyfftw.interfaces.numpy_fft.ifftn(circ_op * xFFT)
+    xFFT = pruned_fftn(xInRO, [2 * L, 2 * M, 2 * N])
+    Y = pruned_ifftn(circulant_multiply(circ_op, xFFT), [L, M, N],
+                     overwrite_input=True)
     xPerm = Mr * Y[0:L, 0:M, 0:N]
     xOut = xInRO - xPerm
     xOut[np.invert(idx)] = 0.0
@@ -50,19 +113,20 @@ def mvp_vec_rho_fftw(xIn, circ_op, circ_op_grad, idx, Mr, Dr_grad,
     xOut = np.zeros((L, M, N), dtype=np.complex128)
     xOutVec = np.zeros((L * M * N, 1), dtype=np.complex128)
 
-    xFFT = pyfftw.interfaces.numpy_fft.fftn(xInRO, [2 * L, 2 * M, 2 * N])
-    Y = pyfftw.interfaces.numpy_fft.ifftn(circ_op * xFFT)
+    xFFT = pruned_fftn(xInRO, [2 * L, 2 * M, 2 * N])
+    Y = pruned_ifftn(circulant_multiply(circ_op, xFFT.copy()), [L, M, N],
+                     overwrite_input=True)
 
     # MVP with gradient of operator
     # x component
-    Y_grad_x = pyfftw.interfaces.numpy_fft.ifftn(circ_op_grad[:, :, :, 0]
-                                                 * xFFT)
+    Y_grad_x = pruned_ifftn(circ_op_grad[:, :, :, 0] * xFFT, [L, M, N],
+                            overwrite_input=True)
     # y component
-    Y_grad_y = pyfftw.interfaces.numpy_fft.ifftn(circ_op_grad[:, :, :, 1]
-                                                 * xFFT)
+    Y_grad_y = pruned_ifftn(circ_op_grad[:, :, :, 1] * xFFT, [L, M, N],
+                            overwrite_input=True)
     # z component
-    Y_grad_z = pyfftw.interfaces.numpy_fft.ifftn(circ_op_grad[:, :, :, 2]
-                                                 * xFFT)
+    Y_grad_z = pruned_ifftn(circ_op_grad[:, :, :, 2] * xFFT, [L, M, N],
+                            overwrite_input=True)
 
     dot_grad = Dr_grad[0, :, :, :] * Y_grad_x[0:L, 0:M, 0:N] + \
         Dr_grad[1, :, :, :] * Y_grad_y[0:L, 0:M, 0:N] + \
@@ -85,7 +149,7 @@ def mvp_vec(xIn, circ_op, idx, Mr):
     xOutVec = np.zeros((L * M * N, 1), dtype=np.complex128)
 
     xFFT = np.fft.fftn(xInRO, [2 * L, 2 * M, 2 * N])
-    Y = np.fft.ifftn(circ_op * xFFT)
+    Y = np.fft.ifftn(circulant_multiply(circ_op, xFFT))
     xPerm = Mr * Y[0:L, 0:M, 0:N]
     xOut = xInRO - xPerm
     xOut[np.invert(idx)] = 0.0
@@ -103,7 +167,7 @@ def mvp_domain(xIn, circ_op, idx, Mr):
     xOutVec = np.zeros((L * M * N, 1), dtype=np.complex128)
 
     xFFT = np.fft.fftn(Mr * xInRO, [2 * L, 2 * M, 2 * N])
-    Y = np.fft.ifftn(circ_op * xFFT)
+    Y = np.fft.ifftn(circulant_multiply(circ_op, xFFT))
     xPerm = Y[0:L, 0:M, 0:N]
     xOut = xInRO - xPerm
     xOut[np.invert(idx)] = 0.0
@@ -111,12 +175,8 @@ def mvp_domain(xIn, circ_op, idx, Mr):
     return xOutVec
 
 
-pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
-pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
 def mvp_volume_potential(xIn, circ_op, idx, Mr):
     ''' Matrix-vector product with FFTW'''
-    pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
-    pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
     (L, M, N) = Mr.shape
     xInRO = xIn.reshape(L, M, N, order='F')
     xInRO[np.invert(idx)] = 0.0
@@ -124,8 +184,9 @@ def mvp_volume_potential(xIn, circ_op, idx, Mr):
     xOut = np.zeros((L, M, N), dtype=np.complex128)
     xOutVec = np.zeros((L * M * N, 1), dtype=np.complex128)
 
-    xFFT = pyfftw.interfaces.numpy_fft.fftn(xInRO, [2 * L, 2 * M, 2 * N])
-    Y = pyfftw.interfaces.numpy_fft.ifftn(circ_op * xFFT)
+    xFFT = pruned_fftn(xInRO, [2 * L, 2 * M, 2 * N])
+    Y = pruned_ifftn(circulant_multiply(circ_op, xFFT), [L, M, N],
+                     overwrite_input=True)
     xOut = Mr * Y[0:L, 0:M, 0:N]
     xOut[np.invert(idx)] = 0.0
     xOutVec = xOut.reshape(L * M * N, 1, order='F')
@@ -143,8 +204,9 @@ def mvp_potential_x_perm(xIn, circ_op, idx, Mr):
 
     # xFFT = np.fft.fftn(Mr * xInRO, [2 * L, 2 * M, 2 * N])
     # Y = np.fft.ifftn(circ_op * xFFT)
-    xFFT = pyfftw.interfaces.numpy_fft.fftn(Mr * xInRO, [2 * L, 2 * M, 2 * N])
-    Y = pyfftw.interfaces.numpy_fft.ifftn(circ_op * xFFT)
+    xFFT = pruned_fftn(Mr * xInRO, [2 * L, 2 * M, 2 * N])
+    Y = pruned_ifftn(circulant_multiply(circ_op, xFFT), [L, M, N],
+                     overwrite_input=True)
     xOut = Y[0:L, 0:M, 0:N]
     xOut[np.invert(idx)] = 0.0
     xOutVec = xOut.reshape(L * M * N, 1, order='F')
@@ -164,20 +226,17 @@ def mvp_potential_grad(xIn, circ_op_grad, idx, Dr_grad, rho_ratio):
 
     # MVP with gradient of operator
     # x component
-    xFFT = pyfftw.interfaces.numpy_fft.fftn(Dr_grad[0, :, :, :] *
-                                            xInRO,
-                                            [2 * L, 2 * M, 2 * N])
-    Y_x = pyfftw.interfaces.numpy_fft.ifftn(circ_op_grad[:, :, :, 0] * xFFT)
+    xFFT = pruned_fftn(Dr_grad[0, :, :, :] * xInRO, [2 * L, 2 * M, 2 * N])
+    Y_x = pruned_ifftn(circ_op_grad[:, :, :, 0] * xFFT, [L, M, N],
+                       overwrite_input=True)
     # y component
-    yFFT = pyfftw.interfaces.numpy_fft.fftn(Dr_grad[1, :, :, :] *
-                                            xInRO,
-                                            [2 * L, 2 * M, 2 * N])
-    Y_y = pyfftw.interfaces.numpy_fft.ifftn(circ_op_grad[:, :, :, 1] * yFFT)
+    yFFT = pruned_fftn(Dr_grad[1, :, :, :] * xInRO, [2 * L, 2 * M, 2 * N])
+    Y_y = pruned_ifftn(circ_op_grad[:, :, :, 1] * yFFT, [L, M, N],
+                       overwrite_input=True)
     # z component
-    zFFT = pyfftw.interfaces.numpy_fft.fftn(Dr_grad[2, :, :, :] *
-                                            xInRO,
-                                            [2 * L, 2 * M, 2 * N])
-    Y_z = pyfftw.interfaces.numpy_fft.ifftn(circ_op_grad[:, :, :, 2] * zFFT)
+    zFFT = pruned_fftn(Dr_grad[2, :, :, :] * xInRO, [2 * L, 2 * M, 2 * N])
+    Y_z = pruned_ifftn(circ_op_grad[:, :, :, 2] * zFFT, [L, M, N],
+                       overwrite_input=True)
 
     xOut = Y_x[0:L, 0:M, 0:N] + Y_y[0:L, 0:M, 0:N] + Y_z[0:L, 0:M, 0:N]
 
@@ -206,3 +265,118 @@ def mvp_potential_grad(xIn, circ_op_grad, idx, Dr_grad, rho_ratio):
     return xOutVec
 
 
+class CirculantMatvec:
+    ''' Matrix-vector products with a circulant operator spectrum (full or
+    octant-compressed) using pruned FFTW plans that are built once for the
+    (2L, 2M, 2N) shape. The object owns SIMD-aligned scratch buffers and
+    runs every FFT in place in them, so repeated products (e.g. GMRES
+    iterations) involve no planning and no large temporaries. The methods
+    mirror the mvp_* functions of this module. '''
+
+    def __init__(self, circ_op, L, M, N, threads=None):
+        if threads is None:
+            threads = pyfftw.config.NUM_THREADS
+        self.circ_op = circ_op
+        (self.L, self.M, self.N) = (L, M, N)
+        shape = (2 * L, 2 * M, 2 * N)
+        self.buf = pyfftw.empty_aligned(shape, dtype='complex128')
+        # Only the leading (L, M, N) block of the buffer is nonzero before
+        # the forward transform or read after the inverse one
+        pruned = PrunedFFT(self.buf, threads=threads)
+        self.fft = pruned.forward
+        self.ifft = pruned.backward
+        self.acc = None
+
+    def convolve(self, x, circ_op=None):
+        ''' Toeplitz product T x of an (L, M, N) array, returned as a view
+        into the scratch buffer (valid until the next product) '''
+        (L, M, N) = (self.L, self.M, self.N)
+        circ_op = self.circ_op if circ_op is None else circ_op
+        self.buf[:] = 0.0
+        self.buf[0:L, 0:M, 0:N] = x
+        self.fft()
+        circulant_multiply(circ_op, self.buf)
+        self.ifft()
+        return self.buf[0:L, 0:M, 0:N]
+
+    def _output(self, out):
+        (L, M, N) = (self.L, self.M, self.N)
+        if out is None:
+            out = np.empty((L * M * N, 1), dtype=np.complex128)
+        return out, out.reshape(L, M, N, order='F')
+
+    def vec(self, xIn, idx, Mr, out=None):
+        ''' As mvp_vec_fftw: (I - Mr T) x '''
+        (L, M, N) = (self.L, self.M, self.N)
+        xInRO = xIn.reshape(L, M, N, order='F')
+        xInRO[np.invert(idx)] = 0.0
+        xOutVec, xOut = self._output(out)
+        Y = self.convolve(xInRO)
+        np.multiply(Mr, Y, out=xOut)
+        np.subtract(xInRO, xOut, out=xOut)
+        xOut[np.invert(idx)] = 0.0
+        return xOutVec
+
+    def domain(self, xIn, idx, Mr, out=None):
+        ''' As mvp_domain: (I - T Mr) x '''
+        (L, M, N) = (self.L, self.M, self.N)
+        xInRO = xIn.reshape(L, M, N, order='F')
+        xInRO[np.invert(idx)] = 0.0
+        xOutVec, xOut = self._output(out)
+        self.buf[:] = 0.0
+        np.multiply(Mr, xInRO, out=self.buf[0:L, 0:M, 0:N])
+        self.fft()
+        circulant_multiply(self.circ_op, self.buf)
+        self.ifft()
+        np.subtract(xInRO, self.buf[0:L, 0:M, 0:N], out=xOut)
+        xOut[np.invert(idx)] = 0.0
+        return xOutVec
+
+    def volume_potential(self, xIn, idx, Mr, out=None):
+        ''' As mvp_volume_potential: Mr T x '''
+        (L, M, N) = (self.L, self.M, self.N)
+        xInRO = xIn.reshape(L, M, N, order='F')
+        xInRO[np.invert(idx)] = 0.0
+        xOutVec, xOut = self._output(out)
+        np.multiply(Mr, self.convolve(xInRO), out=xOut)
+        xOut[np.invert(idx)] = 0.0
+        return xOutVec
+
+    def potential_x_perm(self, xIn, idx, Mr, out=None):
+        ''' As mvp_potential_x_perm: T Mr x '''
+        (L, M, N) = (self.L, self.M, self.N)
+        xInRO = xIn.reshape(L, M, N, order='F')
+        xInRO[np.invert(idx)] = 0.0
+        xOutVec, xOut = self._output(out)
+        self.buf[:] = 0.0
+        np.multiply(Mr, xInRO, out=self.buf[0:L, 0:M, 0:N])
+        self.fft()
+        circulant_multiply(self.circ_op, self.buf)
+        self.ifft()
+        xOut[:] = self.buf[0:L, 0:M, 0:N]
+        xOut[np.invert(idx)] = 0.0
+        return xOutVec
+
+    def potential_grad(self, xIn, circ_op_grad, idx, Dr_grad, out=None):
+        ''' As mvp_potential_grad. The three components are summed in
+        Fourier space, so only one inverse FFT is needed. '''
+        (L, M, N) = (self.L, self.M, self.N)
+        xInRO = xIn.reshape(L, M, N, order='F')
+        xInRO[np.invert(idx)] = 0.0
+        xOutVec, xOut = self._output(out)
+        if self.acc is None:
+            self.acc = pyfftw.empty_aligned(self.buf.shape,
+                                            dtype='complex128')
+        self.acc[:] = 0.0
+        for i in range(0, 3):
+            self.buf[:] = 0.0
+            np.multiply(Dr_grad[i, :, :, :], xInRO,
+                        out=self.buf[0:L, 0:M, 0:N])
+            self.fft()
+            self.buf *= circ_op_grad[:, :, :, i]
+            self.acc += self.buf
+        self.buf[:] = self.acc
+        self.ifft()
+        xOut[:] = self.buf[0:L, 0:M, 0:N]
+        xOut[np.invert(idx)] = 0.0
+        return xOutVec
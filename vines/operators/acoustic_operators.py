@@ -1,209 +1,354 @@
 import numpy as np
 from numba import njit, prange
+from vines.operators.near_field import apply_near_field
 
 
-def volume_potential(ko, r):
-    ''' Create Toeplitz operator '''
+def quadrature_nodes(n_quad=10):
+    ''' Tensor Gauss-Legendre nodes and weights on the reference voxel '''
+    xG, wG = np.polynomial.legendre.leggauss(n_quad)
+    XG, YG, ZG = np.meshgrid(xG, xG, xG)
+    XW, YW, ZW = np.meshgrid(wG*0.5, wG*0.5, wG*0.5)
+    return XG, YG, ZG, XW, YW, ZW
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def potential_fast(ko, r, dx, self, nearby_quad, XG, YG, ZG, XW, YW, ZW):
+    ''' Toeplitz entries of the volume potential (compiled kernel) '''
     (L, M, N, _) = r.shape
-    dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
-    vol = (dx)**3  # voxel volume
-    a = (3/4 * vol / np.pi)**(1/3)  # radius of sphere of same volume
+    n_quad = XG.shape[0]
     R0 = r[0, 0, 0, :]
+    toep = np.zeros((L, M, N), dtype=np.complex128)
+    for i in prange(0, L):
+        for j in range(0, M):
+            for k in range(0, N):
+                R1 = r[i, j, k, :]
+                rk_to_rj = R1-R0
+                rjk = np.linalg.norm(rk_to_rj)
+                if nearby_quad:
+                    if rjk < 5 * dx and rjk > 1e-15:
+                        x_grid = R1[0] + dx/2 * XG
+                        y_grid = R1[1] + dx/2 * YG
+                        z_grid = R1[2] + dx/2 * ZG
 
-    self = (1/ko**2 - 1j*a/ko) * np.exp(1j*ko*a) - 1/ko**2
+                        temp = 0.0+0.0j
+                        for iQ in range(0, n_quad):
+                            for jQ in range(0, n_quad):
+                                for kQ in range(0, n_quad):
+                                    RQ = np.array([x_grid[iQ, jQ, kQ],
+                                                   y_grid[iQ, jQ, kQ],
+                                                   z_grid[iQ, jQ, kQ]])
 
-    nearby_quad = 'off'
-    n_quad = 10
-    xG, wG = np.polynomial.legendre.leggauss(n_quad)
-    XG, YG, ZG = np.meshgrid(xG, xG, xG)
-    XW, YW, ZW = np.meshgrid(wG*0.5, wG*0.5, wG*0.5)
+                                    rk_to_rj = RQ - R0
+                                    rjk = np.linalg.norm(rk_to_rj)
 
-    @njit(parallel=True)
-    def potential_fast(ko):
-        toep = np.zeros((L, M, N), dtype=np.complex128)
-        for i in prange(0, L):
-            for j in range(0, M):
-                for k in range(0, N):
-                    R1 = r[i, j, k, :]
-                    rk_to_rj = R1-R0
-                    rjk = np.linalg.norm(rk_to_rj)
-                    if nearby_quad in 'on':
-                        if rjk < 5 * dx and rjk > 1e-15:
-                            x_grid = R1[0] + dx/2 * XG
-                            y_grid = R1[1] + dx/2 * YG
-                            z_grid = R1[2] + dx/2 * ZG
-
-                            temp = 0.0+0.0j
-                            for iQ in range(0, n_quad):
-                                for jQ in range(0, n_quad):
-                                    for kQ in range(0, n_quad):
-                                        RQ = np.array([x_grid[iQ, jQ, kQ],
-                                                       y_grid[iQ, jQ, kQ],
-                                                       z_grid[iQ, jQ, kQ]])
-
-                                        rk_to_rj = RQ - R0
-                                        rjk = np.linalg.norm(rk_to_rj)
-
-                                        Ajk = np.exp(1j * ko * rjk) / \
-                                            (4 * np.pi * rjk) * dx**3
-                                        temp += Ajk * XW[iQ, jQ, kQ] * \
-                                            YW[iQ, jQ, kQ] * ZW[iQ, jQ, kQ]
-                            toep[i, j, k] = temp
-                        else:
-                            if np.abs(rjk) > 1e-15:
-                                toep[i, j, k] = np.exp(1j * ko * rjk) / \
+                                    Ajk = np.exp(1j * ko * rjk) / \
                                         (4 * np.pi * rjk) * dx**3
-                            else:
-                                toep[i, j, k] = self
+                                    temp += Ajk * XW[iQ, jQ, kQ] * \
+                                        YW[iQ, jQ, kQ] * ZW[iQ, jQ, kQ]
+                        toep[i, j, k] = temp
                     else:
                         if np.abs(rjk) > 1e-15:
                             toep[i, j, k] = np.exp(1j * ko * rjk) / \
-                                (4 * np.pi * rjk) * dx**3
+                                    (4 * np.pi * rjk) * dx**3
                         else:
                             toep[i, j, k] = self
-        return toep
+                else:
+                    if np.abs(rjk) > 1e-15:
+                        toep[i, j, k] = np.exp(1j * ko * rjk) / \
+                            (4 * np.pi * rjk) * dx**3
+                    else:
+                        toep[i, j, k] = self
+    return toep
 
-    return potential_fast(ko)
 
+@njit(cache=True, nogil=True)
+def radial_factors(ko, dx, n_max):
+    ''' Radial factors of the potential and of its gradient, tabulated
+    against the squared integer offset s = i**2 + j**2 + k**2. A single
+    complex exponential serves both tables. '''
+    g = np.zeros(n_max + 1, dtype=np.complex128)
+    dg = np.zeros(n_max + 1, dtype=np.complex128)
+    for s in range(1, n_max + 1):
+        rjk = dx * np.sqrt(s)
+        e = np.exp(1j * ko * rjk)
+        g[s] = e / (4 * np.pi * rjk) * dx**3
+        dg[s] = e * (1j * ko * rjk - 1) / (4 * np.pi * rjk**3) * dx**3
+    return g, dg
 
-def volume_potential_cylindrical(ko, r):
-    ''' Create Toeplitz operator for cylindrically symmetric case '''
+
+@njit(parallel=True, cache=True, nogil=True)
+def scatter_radial(g, L, M, N):
+    ''' Fill the Toeplitz array from the radial lookup table '''
+    toep = np.zeros((L, M, N), dtype=np.complex128)
+    for i in prange(0, L):
+        for j in range(0, M):
+            for k in range(0, N):
+                toep[i, j, k] = g[i*i + j*j + k*k]
+    return toep
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def scatter_radial_grad(dg, dx, L, M, N):
+    ''' Fill the gradient Toeplitz array from the radial lookup table '''
+    toep = np.zeros((L, M, N, 3), dtype=np.complex128)
+    for i in prange(0, L):
+        for j in range(0, M):
+            for k in range(0, N):
+                temp = dg[i*i + j*j + k*k] * dx
+                toep[i, j, k, 0] = temp * i
+                toep[i, j, k, 1] = temp * j
+                toep[i, j, k, 2] = temp * k
+    return toep
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def scatter_radial_circulant(g, circ):
+    ''' Fill the (2L, 2M, 2N) circulant kernel in place from the radial
+    lookup table, evaluating it directly at the wrapped offsets '''
+    (L, M, N) = (circ.shape[0] // 2, circ.shape[1] // 2, circ.shape[2] // 2)
+    for i in prange(0, 2 * L):
+        ii = min(i, 2 * L - i)
+        for j in range(0, 2 * M):
+            jj = min(j, 2 * M - j)
+            for k in range(0, 2 * N):
+                kk = min(k, 2 * N - k)
+                if i == L or j == M or k == N:
+                    circ[i, j, k] = 0.0
+                else:
+                    circ[i, j, k] = g[ii*ii + jj*jj + kk*kk]
+
+
+def is_cubic(r):
+    ''' True if the voxels of grid r are cubes, so that the kernel depends
+    only on the squared integer offset '''
     (L, M, N, _) = r.shape
     dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
+    dy = r[0, 1, 0, 1] - r[0, 0, 0, 1] if M > 1 else dx
+    dz = r[0, 0, 1, 2] - r[0, 0, 0, 2] if N > 1 else dx
+    return np.isclose(dy, dx, rtol=1e-10) and np.isclose(dz, dx, rtol=1e-10)
+
+
+def volume_potential_self(ko, dx):
+    ''' Self term: integral over the sphere with the voxel's volume '''
     vol = (dx)**3  # voxel volume
     a = (3/4 * vol / np.pi)**(1/3)  # radius of sphere of same volume
-    R0 = r[0, 0, 0, :]
+    return (1/ko**2 - 1j*a/ko) * np.exp(1j*ko*a) - 1/ko**2
 
-    # self = (1/ko**2 - 1j*a/ko) * np.exp(1j*ko*a) - 1/ko**2
-    self = 1/(2j*ko) * (np.exp(1j*ko*a) - 1)
 
-    # @njit(parallel=True)
-    # def potential_fast_cylindrical(ko):
-    #     toep = np.zeros((L, M, N), dtype=np.complex128)
-    #     for i in prange(0, L):
-    #         for j in range(0, M):
-    #             for k in range(0, N):
-    #                 R1 = r[i, j, k, :]
-    #                 rk_to_rj = R1-R0
-    #                 rjk = np.linalg.norm(rk_to_rj)
-
-    #                 if np.abs(rjk) > 1e-15:
-    #                     # toep[i, j, k] = np.exp(1j * ko * rjk) / \
-    #                     #     (4 * np.pi * rjk) * dx**2 * np.abs(R1[1])
-    #                     toep[i, j, k] = np.exp(1j * ko * rjk) / \
-    #                         (4 * np.pi * rjk) * dx**2
-    #                 else:
-    #                     toep[i, j, k] = self
-    #     return toep
-
-    @njit(parallel=True)
-    def potential_fast_cylindrical(ko):
-        ntheta = 400
-        dtheta = 2*np.pi / ntheta
-        # theta = np.linspace(dtheta/2, np.pi - dtheta/2, ntheta)
-        theta = np.linspace(0, 2*np.pi - dtheta, ntheta)
-        # theta = 0
-        toep = np.zeros((L, M, N), dtype=np.complex128)
-        for i in prange(0, L):
-            for j in range(0, M):
-                for k in range(0, N):
-                    temp = 0
-                    for THETA in theta:
-                        R1_temp = r[i, j, k, :]
-                        R1 = np.array([R1_temp[0],
-                                       R1_temp[1] * np.cos(THETA),
-                                       R1_temp[1] * np.sin(THETA)])
-                        # R1 = np.array([R1_temp[0],
-                        #                R1_temp[1],
-                        #                np.abs(R1_temp[1]) * np.sin(THETA)])
-                        # R1 = r[i, j, k, :]
-                        rk_to_rj = R1-R0
-                        rjk = np.linalg.norm(rk_to_rj)
+def volume_potential(ko, r, nearby_quad='off', assembly='radial'):
+    ''' Create Toeplitz operator. With assembly='radial' (cubic voxels)
+    the kernel is evaluated once per distinct squared offset and scattered
+    through a lookup table, and nearby_quad='on' overwrites the entries
+    within 5 voxels of the origin from the cached near-field table;
+    'direct' evaluates everything voxel by voxel. '''
+    (L, M, N, _) = r.shape
+    dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
+    ko = np.complex128(ko)
 
-                        if np.abs(rjk) > 1e-15:
-                            # toep[i, j, k] = np.exp(1j * ko * rjk) / \
-                            #     (4 * np.pi * rjk) * dx**2 * np.abs(R1[1])
-                            temp += np.exp(1j * ko * rjk) / \
-                                (4 * np.pi * rjk) * dx**2
-                        else:
-                            temp += self
-                    toep[i, j, k] = temp * dtheta  #* np.abs(R1_temp[1])
+    self = volume_potential_self(ko, dx)
+
+    if assembly in 'radial' and is_cubic(r):
+        g, _ = radial_factors(ko, dx, (L-1)**2 + (M-1)**2 + (N-1)**2)
+        g[0] = self
+        toep = scatter_radial(g, L, M, N)
+        if nearby_quad in 'on':
+            apply_near_field(toep, 'potential', ko, dx)
         return toep
 
-    return potential_fast_cylindrical(ko)
+    XG, YG, ZG, XW, YW, ZW = quadrature_nodes()
 
+    return potential_fast(ko, np.ascontiguousarray(r), dx, self,
+                          nearby_quad in 'on', XG, YG, ZG, XW, YW, ZW)
 
-def grad_potential(ko, r):
-    ''' Create Toeplitz operator '''
+
+def volume_potential_circulant(ko, r, nearby_quad='off'):
+    ''' FFT of the circulant embedding of the volume potential, assembled
+    directly on the (2L, 2M, 2N) periodic grid and transformed in place.
+    Equal to circulant_embed_fftw(volume_potential(ko, r), L, M, N) without
+    the Toeplitz array, the zero-padded copy or the slab copies. '''
+    from vines.precondition.threeD import (fftn_inplace_plan,
+                                           circulant_embed_fftw)
+    from vines.operators.near_field import apply_near_field_circulant
     (L, M, N, _) = r.shape
+    if not is_cubic(r):
+        return circulant_embed_fftw(volume_potential(ko, r, nearby_quad),
+                                    L, M, N)
+    dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
+    ko = np.complex128(ko)
+
+    circ, fft_plan = fftn_inplace_plan((2 * L, 2 * M, 2 * N))
+    g, _ = radial_factors(ko, dx, (L-1)**2 + (M-1)**2 + (N-1)**2)
+    g[0] = volume_potential_self(ko, dx)
+    scatter_radial_circulant(g, circ)
+    if nearby_quad in 'on':
+        apply_near_field_circulant(circ, 'potential', ko, dx)
+    fft_plan()
+    return circ
+
+
+@njit(parallel=True, cache=True)
+def potential_fast_cylindrical(ko, r, dx, self, ntheta):
+    ''' Toeplitz entries of the cylindrically symmetric volume potential '''
+    (L, M, N, _) = r.shape
+    R0 = r[0, 0, 0, :]
+    dtheta = 2*np.pi / ntheta
+    # theta = np.linspace(dtheta/2, np.pi - dtheta/2, ntheta)
+    theta = np.linspace(0, 2*np.pi - dtheta, ntheta)
+    toep = np.zeros((L, M, N), dtype=np.complex128)
+    for i in prange(0, L):
+        for j in range(0, M):
+            for k in range(0, N):
+                temp = 0.0+0.0j
+                for THETA in theta:
+                    R1_temp = r[i, j, k, :]
+                    R1 = np.array([R1_temp[0],
+                                   R1_temp[1] * np.cos(THETA),
+                                   R1_temp[1] * np.sin(THETA)])
+                    rk_to_rj = R1-R0
+                    rjk = np.linalg.norm(rk_to_rj)
+
+                    if np.abs(rjk) > 1e-15:
+                        # toep[i, j, k] = np.exp(1j * ko * rjk) / \
+                        #     (4 * np.pi * rjk) * dx**2 * np.abs(R1[1])
+                        temp += np.exp(1j * ko * rjk) / \
+                            (4 * np.pi * rjk) * dx**2
+                    else:
+                        temp += self
+                toep[i, j, k] = temp * dtheta  #* np.abs(R1_temp[1])
+    return toep
+
+
+def volume_potential_cylindrical(ko, r):
+    ''' Create Toeplitz operator for cylindrically symmetric case '''
     dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
     vol = (dx)**3  # voxel volume
     a = (3/4 * vol / np.pi)**(1/3)  # radius of sphere of same volume
+    ko = np.complex128(ko)
+
+    # self = (1/ko**2 - 1j*a/ko) * np.exp(1j*ko*a) - 1/ko**2
+    self = 1/(2j*ko) * (np.exp(1j*ko*a) - 1)
+
+    return potential_fast_cylindrical(ko, np.ascontiguousarray(r), dx, self,
+                                      400)
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def grad_potential_fast(ko, r, dx, self, nearby_quad, XG, YG, ZG, XW, YW,
+                        ZW):
+    ''' Toeplitz entries of the gradient of the volume potential '''
+    (L, M, N, _) = r.shape
+    n_quad = XG.shape[0]
     R0 = r[0, 0, 0, :]
+    toep = np.zeros((L, M, N, 3), dtype=np.complex128)
+    for i in prange(0, L):
+        for j in range(0, M):
+            for k in range(0, N):
+                R1 = r[i, j, k, :]
+                rk_to_rj = R1-R0
+                rjk = np.linalg.norm(rk_to_rj)
+                if nearby_quad:
+                    if rjk < 5 * dx and rjk > 1e-15:
+                        x_grid = R1[0] + dx/2 * XG
+                        y_grid = R1[1] + dx/2 * YG
+                        z_grid = R1[2] + dx/2 * ZG
 
-    self = 0.0
+                        temp = np.zeros(3, dtype=np.complex128)
+                        for iQ in range(0, n_quad):
+                            for jQ in range(0, n_quad):
+                                for kQ in range(0, n_quad):
+                                    RQ = np.array([x_grid[iQ, jQ, kQ],
+                                                   y_grid[iQ, jQ, kQ],
+                                                   z_grid[iQ, jQ, kQ]])
 
-    nearby_quad = 'off'
-    n_quad = 10
-    xG, wG = np.polynomial.legendre.leggauss(n_quad)
-    XG, YG, ZG = np.meshgrid(xG, xG, xG)
-    XW, YW, ZW = np.meshgrid(wG*0.5, wG*0.5, wG*0.5)
+                                    rk_to_rj = RQ - R0
+                                    rjk = np.linalg.norm(rk_to_rj)
 
-    @njit(parallel=True)
-    def grad_potential_fast(ko):
-        toep = np.zeros((L, M, N, 3), dtype=np.complex128)
-        for i in prange(0, L):
-            for j in range(0, M):
-                for k in range(0, N):
-                    R1 = r[i, j, k, :]
-                    rk_to_rj = R1-R0
-                    rjk = np.linalg.norm(rk_to_rj)
-                    if nearby_quad in 'on':
-                        if rjk < 5 * dx and rjk > 1e-15:
-                            x_grid = R1[0] + dx/2 * XG
-                            y_grid = R1[1] + dx/2 * YG
-                            z_grid = R1[2] + dx/2 * ZG
-
-                            temp = 0.0+0.0j
-                            for iQ in range(0, n_quad):
-                                for jQ in range(0, n_quad):
-                                    for kQ in range(0, n_quad):
-                                        RQ = np.array([x_grid[iQ, jQ, kQ],
-                                                       y_grid[iQ, jQ, kQ],
-                                                       z_grid[iQ, jQ, kQ]])
-
-                                        rk_to_rj = RQ - R0
-                                        rjk = np.linalg.norm(rk_to_rj)
-
-                                        # Ajk = np.exp(1j * ko * rjk) / \
-                                        #     (4 * np.pi * rjk) * dx**3
-
-                                        Ajk = np.exp(1j * ko * rjk) * \
-                                            (1j * ko * rjk - 1) / \
-                                            (4 * np.pi * rjk**3) * dx**3 * \
-                                            rk_to_rj
-
-                                        temp += Ajk * XW[iQ, jQ, kQ] * \
-                                            YW[iQ, jQ, kQ] * ZW[iQ, jQ, kQ]
-                            toep[i, j, k, :] = temp
-                        else:
-                            if np.abs(rjk) > 1e-15:
-                                # toep[i, j, k] = np.exp(1j * ko * rjk) / \
-                                #         (4 * np.pi * rjk) * dx**3
-                                toep[i, j, k, :] = np.exp(1j * ko * rjk) * \
-                                            (1j * ko * rjk - 1) / \
-                                            (4 * np.pi * rjk**3) * dx**3 * \
-                                            rk_to_rj
-                            else:
-                                toep[i, j, k, :] = self
+                                    Ajk = np.exp(1j * ko * rjk) * \
+                                        (1j * ko * rjk - 1) / \
+                                        (4 * np.pi * rjk**3) * dx**3 * \
+                                        rk_to_rj
+
+                                    temp += Ajk * XW[iQ, jQ, kQ] * \
+                                        YW[iQ, jQ, kQ] * ZW[iQ, jQ, kQ]
+                        toep[i, j, k, :] = temp
                     else:
                         if np.abs(rjk) > 1e-15:
                             toep[i, j, k, :] = np.exp(1j * ko * rjk) * \
-                                            (1j * ko * rjk - 1) / \
-                                            (4 * np.pi * rjk**3) * dx**3 * \
-                                            rk_to_rj
+                                        (1j * ko * rjk - 1) / \
+                                        (4 * np.pi * rjk**3) * dx**3 * \
+                                        rk_to_rj
                         else:
                             toep[i, j, k, :] = self
+                else:
+                    if np.abs(rjk) > 1e-15:
+                        toep[i, j, k, :] = np.exp(1j * ko * rjk) * \
+                                        (1j * ko * rjk - 1) / \
+                                        (4 * np.pi * rjk**3) * dx**3 * \
+                                        rk_to_rj
+                    else:
+                        toep[i, j, k, :] = self
+    return toep
+
+
+def grad_potential(ko, r, nearby_quad='off', assembly='radial'):
+    ''' Create Toeplitz operator '''
+    (L, M, N, _) = r.shape
+    dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
+    ko = np.complex128(ko)
+
+    self = 0.0 + 0.0j
+
+    if assembly in 'radial' and is_cubic(r):
+        _, dg = radial_factors(ko, dx, (L-1)**2 + (M-1)**2 + (N-1)**2)
+        toep = scatter_radial_grad(dg, dx, L, M, N)
+        if nearby_quad in 'on':
+            apply_near_field(toep, 'grad', ko, dx)
         return toep
 
-    return grad_potential_fast(ko)
+    XG, YG, ZG, XW, YW, ZW = quadrature_nodes()
+
+    return grad_potential_fast(ko, np.ascontiguousarray(r), dx, self,
+                               nearby_quad in 'on', XG, YG, ZG, XW, YW, ZW)
+
+
+def volume_and_grad_potential(ko, r, nearby_quad='off'):
+    ''' Toeplitz operators of the volume potential and of its gradient,
+    sharing the radial factors (cubic voxels) '''
+    (L, M, N, _) = r.shape
+    dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
+    ko = np.complex128(ko)
+
+    if not is_cubic(r):
+        return volume_potential(ko, r, nearby_quad), \
+            grad_potential(ko, r, nearby_quad)
+
+    g, dg = radial_factors(ko, dx, (L-1)**2 + (M-1)**2 + (N-1)**2)
+    g[0] = volume_potential_self(ko, dx)
+    toep = scatter_radial(g, L, M, N)
+    toep_grad = scatter_radial_grad(dg, dx, L, M, N)
+    if nearby_quad in 'on':
+        apply_near_field(toep, 'potential', ko, dx)
+        apply_near_field(toep_grad, 'grad', ko, dx)
+    return toep, toep_grad
+
+
+def compile_kernels():
+    ''' Compile (or load from the on-disk cache) all assembly kernels.
+    Call once at start-up, or run
+    `python -m vines.operators.acoustic_operators` after installation, so
+    that the first assembly does not pay for JIT. '''
+    x = np.arange(2, dtype=np.float64)
+    r = np.zeros((2, 2, 2, 3))
+    r[:, :, :, 0] = x[:, None, None]
+    r[:, :, :, 1] = x[None, :, None]
+    r[:, :, :, 2] = x[None, None, :]
+    volume_potential(1.0, r)
+    volume_potential(1.0, r, assembly='direct')
+    volume_potential_circulant(1.0, r)
+    grad_potential(1.0, r)
+    grad_potential(1.0, r, assembly='direct')
+    volume_potential_cylindrical(1.0, r)
+
+
+if __name__ == '__main__':
+    compile_kernels()
@@ -0,0 +1,106 @@
+# Persistent FFTW wisdom
+#
+# FFTW_MEASURE (and FFTW_PATIENT) planning is repeated by every new process
+# for every grid shape. The accumulated wisdom is exported to a cache file
+# on exit and imported when vines' matvec modules are loaded, so production
+# runs on recurring grid sizes start with tuned plans at no planning cost.
+#
+# Shapes can be tuned ahead of time with
+#
+#     python -m vines.operators.fftw_wisdom L M N [--effort FFTW_PATIENT]
+#
+# where (L, M, N) is the voxel grid (the transforms are of size 2L x 2M x 2N).
+# The file location defaults to the VINES_FFTW_WISDOM environment variable.
+
+import os
+import atexit
+import pickle
+import threading
+import multiprocessing
+import pyfftw
+
+WISDOM_FILE = os.environ.get(
+    'VINES_FFTW_WISDOM',
+    os.path.join(os.path.expanduser('~'), '.cache', 'vines',
+                 'fftw_wisdom.pickle'))
+
+_configured = False
+
+
+def load_wisdom(path=None):
+    ''' Import FFTW wisdom from the cache file, if present '''
+    path = WISDOM_FILE if path is None else path
+    try:
+        with open(path, 'rb') as f:
+            pyfftw.import_wisdom(pickle.load(f))
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+            TypeError):
+        pass
+
+
+def save_wisdom(path=None):
+    ''' Export all wisdom accumulated by this process to the cache file.
+    Wisdom already in the file was imported at start-up, so nothing is
+    lost by overwriting it. '''
+    path = WISDOM_FILE if path is None else path
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.{0}.{1}.tmp'.format(os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            pickle.dump(pyfftw.export_wisdom(), f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def configure():
+    ''' Use all cores and FFTW_MEASURE planning, import the stored wisdom
+    and export it again at exit. Safe to call more than once. '''
+    global _configured
+    pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
+    pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
+    if not _configured:
+        load_wisdom()
+        atexit.register(save_wisdom)
+        _configured = True
+
+
+def tune(L, M, N, effort='FFTW_PATIENT', threads=None, maxwell=False):
+    ''' Plan the transforms used by the matvecs on an (L, M, N) voxel grid
+    with the given planner effort and store the resulting wisdom. Later
+    plans for this shape made with a lower effort reuse it. '''
+    from vines.operators.pruned_fft import PrunedFFT
+    configure()
+    threads = pyfftw.config.NUM_THREADS if threads is None else threads
+    shape = (2 * L, 2 * M, 2 * N)
+    a = pyfftw.empty_aligned(shape, dtype='complex128')
+    b = pyfftw.empty_aligned(shape, dtype='complex128')
+    # Pruned transforms (matvecs) and full in place and out of place
+    # transforms (circulant embedding, numpy_fft interfaces)
+    PrunedFFT(a, threads=threads, flags=(effort,))
+    for direction in ('FFTW_FORWARD', 'FFTW_BACKWARD'):
+        pyfftw.FFTW(a, a, axes=(0, 1, 2), direction=direction,
+                    threads=threads, flags=(effort,))
+        pyfftw.FFTW(a, b, axes=(0, 1, 2), direction=direction,
+                    threads=threads, flags=(effort,))
+    if maxwell:
+        c = pyfftw.empty_aligned((3,) + shape, dtype='complex128')
+        PrunedFFT(c, axes=(1, 2, 3), threads=threads, flags=(effort,))
+    save_wisdom()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Tune FFTW plans for a voxel grid and store the wisdom')
+    parser.add_argument('shape', type=int, nargs=3, metavar=('L', 'M', 'N'))
+    parser.add_argument('--effort', default='FFTW_PATIENT',
+                        choices=['FFTW_MEASURE', 'FFTW_PATIENT',
+                                 'FFTW_EXHAUSTIVE'])
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--maxwell', action='store_true',
+                        help='also tune the batched Maxwell transforms')
+    args = parser.parse_args()
+    tune(*args.shape, effort=args.effort, threads=args.threads,
+         maxwell=args.maxwell)
+    print('Wisdom stored in', WISDOM_FILE)
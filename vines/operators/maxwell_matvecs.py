@@ -1,5 +1,7 @@
 import pyfftw
-import multiprocessing
+from vines.operators.fftw_wisdom import configure
+from vines.operators.pruned_fft import pruned_fftn, pruned_ifftn, PrunedFFT
+configure()
 # Matrix-vector product with Toeplitz operator
 def mvp_vec(JIn0, op_out, idx, Gram, Mr, Mc):    
     import numpy as np
@@ -43,37 +45,24 @@ def mvp_vec(JIn0, op_out, idx, Gram, Mr, Mc):
     
     return JOutVec
 
-# Matrix-vector product with 2-level circulant preconditioner
+# Matrix-vector product with 2-level circulant preconditioner. The x and y
+# levels are whole-array FFTs and the (L, M) block products one batched
+# matmul; the blocks act on vectors of length 3N ordered (z, component).
 def mvp_circ2(JInVec, circ2_inv, L, M, N, idx):
     import numpy as np
     V_R = JInVec.reshape(L, M, N, 3, order='F')
-    V_R[np.invert(idx)] = 0.0 
-    
-    Vrhs = V_R.reshape(3*L*M*N, 1, order='F')
-
-    temp = Vrhs.reshape(L,3*M*N, order='F')
-    temp = np.fft.fft(temp, axis=0).T  # transpose is application of permutation matrix
-
-    for i in range(0, L):
-        TEMP = temp[:, i].reshape(M,3*N, order='F')
-        TEMP = np.fft.fft(TEMP, axis=0).T
-        for j in range(0, M):
-            TEMP[:,j] = np.matmul(circ2_inv[i, j, :, :], TEMP[:, j])
-
-        TEMP = np.fft.ifft(TEMP.T, axis=0)
-        temp[:, i] = TEMP.reshape(1,3*M*N, order='F')
+    V_R[np.invert(idx)] = 0.0
 
+    temp = np.fft.fft2(V_R, axes=(0, 1))
+    temp = temp.transpose(0, 1, 3, 2).reshape(L, M, 3*N, 1)
+    temp = np.matmul(circ2_inv, temp).reshape(L, M, 3, N)
+    temp = np.fft.ifft2(temp.transpose(0, 1, 3, 2), axes=(0, 1))
 
-    temp = np.fft.ifft(temp.T, axis=0)  # transpose is application of permutation matrix transpose
-    TEMP = temp.reshape(3*L*M*N,1, order='F')
-    TEMP_RO = TEMP.reshape(L, M, N, 3, order='F')
-    TEMP_RO[np.invert(idx)] = 0.0 +0j 
-    matvec = TEMP_RO.reshape(3*L*M*N, 1, order='F')
+    temp[np.invert(idx)] = 0.0 + 0j
+    matvec = temp.reshape(3*L*M*N, 1, order='F')
     return matvec
 
 # Same as above but now using FFTW
-# Configure PyFFTW to use all cores (the default is single-threaded)
-pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
 def mvp_vec_fftw(JIn0, op_out, idx, Gram, Mr, Mc):    
     import numpy as np
 
@@ -85,29 +74,29 @@ def mvp_vec_fftw(JIn0, op_out, idx, Gram, Mr, Mc):
     JOutVec = np.zeros((3 * L * M* N, 1), dtype=np.complex128)
     
     # x component of JIn, store contribution on 3 components of Jout
-    fJ = pyfftw.interfaces.numpy_fft.fftn(JIn[:, :, :, 0], (2*L, 2*M, 2*N))
+    fJ = pruned_fftn(JIn[:, :, :, 0], (2*L, 2*M, 2*N))
     Jout1 = op_out[:, :, :, 0] * fJ
     Jout2 = op_out[:, :, :, 1] * fJ
     Jout3 = op_out[:, :, :, 2] * fJ
     
     # y component of JIn, add contribution on 3 components of Jout
-    fJ = pyfftw.interfaces.numpy_fft.fftn(JIn[:, :, :, 1], (2*L, 2*M, 2*N))
+    fJ = pruned_fftn(JIn[:, :, :, 1], (2*L, 2*M, 2*N))
     Jout1 = Jout1 + op_out[:, :, :, 1] * fJ
     Jout2 = Jout2 + op_out[:, :, :, 3] * fJ
     Jout3 = Jout3 + op_out[:, :, :, 4] * fJ
     
     # z component of JIn, add contribution on 3 components of Jout
-    fJ = pyfftw.interfaces.numpy_fft.fftn(JIn[:, :, :, 2], (2*L, 2*M, 2*N))
+    fJ = pruned_fftn(JIn[:, :, :, 2], (2*L, 2*M, 2*N))
     Jout1 = Jout1 + op_out[:, :, :, 2] * fJ
     Jout2 = Jout2 + op_out[:, :, :, 4] * fJ
     Jout3 = Jout3 + op_out[:, :, :, 5] * fJ
                            
     # apply ifft, multiply by material properties and Gram
-    Jout1 = pyfftw.interfaces.numpy_fft.ifftn(Jout1)
+    Jout1 = pruned_ifftn(Jout1, (L, M, N), overwrite_input=True)
     JOut[:, :, :, 0] = Gram * Mr * JIn[:, :, :, 0] - Mc * Jout1[0:L, 0:M, 0:N]
-    Jout2 = pyfftw.interfaces.numpy_fft.ifftn(Jout2)
+    Jout2 = pruned_ifftn(Jout2, (L, M, N), overwrite_input=True)
     JOut[:, :, :, 1] = Gram * Mr * JIn[:, :, :, 1] - Mc * Jout2[0:L, 0:M, 0:N]
-    Jout3 = pyfftw.interfaces.numpy_fft.ifftn(Jout3)
+    Jout3 = pruned_ifftn(Jout3, (L, M, N), overwrite_input=True)
     JOut[:, :, :, 2] = Gram * Mr * JIn[:, :, :, 2] - Mc * Jout3[0:L, 0:M, 0:N]
     
     JOut[np.invert(idx)] = 0.0
@@ -116,30 +105,104 @@ def mvp_vec_fftw(JIn0, op_out, idx, Gram, Mr, Mc):
     
     return JOutVec
 
-pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
-def mvp_circ2_fftw(JInVec, circ2_inv, L, M, N, idx):
+def mvp_vec_fftw_block(JIn0, op_out, idx, Gram, Mr, Mc, chunk=None):
+    ''' mvp_vec_fftw for a block of right-hand sides, JIn0 of shape
+    (3*L*M*N, n_rhs). The FFTs of all components of a chunk of columns run
+    as one batched transform, and each slab of the operator spectrum is
+    applied to all of them while it is in cache. '''
     import numpy as np
-    V_R = JInVec.reshape(L, M, N, 3, order='F')
-    V_R[np.invert(idx)] = 0.0 
-    
-    Vrhs = V_R.reshape(3*L*M*N, 1, order='F')
 
-    temp = Vrhs.reshape(L,3*M*N, order='F')
-    temp = pyfftw.interfaces.numpy_fft.fft(temp, axis=0).T  # transpose is application of permutation matrix
+    (L, M, N) = Mr.shape
+    n_rhs = JIn0.shape[1]
+    chunk = n_rhs if chunk is None else chunk
+    JIn = JIn0.reshape(L, M, N, 3, n_rhs, order='F')
+    JIn[np.invert(idx)] = 0.0
+
+    JOutVec = np.zeros((3 * L * M * N, n_rhs), dtype=np.complex128)
+    JOut = JOutVec.reshape(L, M, N, 3, n_rhs, order='F')
+    comp = [[0, 1, 2], [1, 3, 4], [2, 4, 5]]
+
+    for j in range(0, n_rhs, chunk):
+        cols = slice(j, min(j + chunk, n_rhs))
+        # (column, component, x, y, z): contiguous 3-D transforms
+        fJ = pruned_fftn(JIn[:, :, :, :, cols].transpose(4, 3, 0, 1, 2),
+                         (2*L, 2*M, 2*N), axes=(2, 3, 4))
+        Jout = pyfftw.zeros_aligned(fJ.shape, dtype='complex128')
+        for i in range(0, 2*L):
+            for c in range(0, 3):
+                for d in range(0, 3):
+                    Jout[:, d, i] += op_out[i, :, :, comp[c][d]] * fJ[:, c, i]
+        del fJ
+        Jout = pruned_ifftn(Jout, (L, M, N), axes=(2, 3, 4),
+                            overwrite_input=True)
+        # multiply by material properties and Gram
+        JOut[:, :, :, :, cols] = (Gram * Mr)[:, :, :, None, None] * \
+            JIn[:, :, :, :, cols] - \
+            Mc[:, :, :, None, None] * Jout.transpose(2, 3, 4, 1, 0)
 
-    for i in range(0, L):
-        TEMP = temp[:, i].reshape(M,3*N, order='F')
-        TEMP = pyfftw.interfaces.numpy_fft.fft(TEMP, axis=0).T
-        for j in range(0, M):
-            TEMP[:,j] = np.matmul(circ2_inv[i, j, :, :], TEMP[:, j])
+    JOut[np.invert(idx)] = 0.0
+    return JOutVec
 
-        TEMP = pyfftw.interfaces.numpy_fft.ifft(TEMP.T, axis=0)
-        temp[:, i] = TEMP.reshape(1,3*M*N, order='F')
+def mvp_circ2_fftw(JInVec, circ2_inv, L, M, N, idx):
+    import numpy as np
+    V_R = JInVec.reshape(L, M, N, 3, order='F')
+    V_R[np.invert(idx)] = 0.0
+
+    temp = pyfftw.interfaces.numpy_fft.fft2(V_R, axes=(0, 1))
+    temp = temp.transpose(0, 1, 3, 2).reshape(L, M, 3*N, 1)
+    temp = np.matmul(circ2_inv, temp).reshape(L, M, 3, N)
+    temp = pyfftw.interfaces.numpy_fft.ifft2(temp.transpose(0, 1, 3, 2),
+                                             axes=(0, 1))
 
+    temp[np.invert(idx)] = 0.0 + 0j
+    matvec = temp.reshape(3*L*M*N, 1, order='F')
+    return matvec
 
-    temp = pyfftw.interfaces.numpy_fft.ifft(temp.T, axis=0)  # transpose is application of permutation matrix transpose
-    TEMP = temp.reshape(3*L*M*N,1, order='F')
-    TEMP_RO = TEMP.reshape(L, M, N, 3, order='F')
-    TEMP_RO[np.invert(idx)] = 0.0 +0j 
-    matvec = TEMP_RO.reshape(3*L*M*N, 1, order='F')
-    return matvec
\ No newline at end of file
+class MaxwellCirculantMatvec:
+    ''' Matrix-vector product of mvp_vec_fftw with pruned FFTW plans built
+    once for the (2L, 2M, 2N) shape. The object owns SIMD-aligned scratch
+    buffers: one for the forward transforms and one holding the three
+    output components, which are inverse-transformed together. '''
+
+    def __init__(self, op_out, threads=None):
+        import numpy as np
+        if threads is None:
+            threads = pyfftw.config.NUM_THREADS
+        self.op_out = op_out
+        shape = op_out.shape[0:3]
+        (self.L, self.M, self.N) = [n // 2 for n in shape]
+        self.buf = pyfftw.empty_aligned(shape, dtype='complex128')
+        self.acc = pyfftw.empty_aligned((3,) + shape, dtype='complex128')
+        self.fft = PrunedFFT(self.buf, threads=threads).forward
+        self.ifft = PrunedFFT(self.acc, axes=(1, 2, 3),
+                              threads=threads).backward
+        # Operator component coupling input component c to output d
+        self.comp = np.array([[0, 1, 2], [1, 3, 4], [2, 4, 5]])
+
+    def vec(self, JIn0, idx, Gram, Mr, Mc, out=None):
+        ''' As mvp_vec_fftw '''
+        import numpy as np
+        (L, M, N) = (self.L, self.M, self.N)
+        JIn = JIn0.reshape(L, M, N, 3, order='F')
+        JIn[np.invert(idx)] = 0.0
+        if out is None:
+            out = np.empty((3 * L * M * N, 1), dtype=np.complex128)
+        JOut = out.reshape(L, M, N, 3, order='F')
+
+        self.acc[:] = 0.0
+        for c in range(0, 3):
+            self.buf[:] = 0.0
+            self.buf[0:L, 0:M, 0:N] = JIn[:, :, :, c]
+            self.fft()
+            for d in range(0, 3):
+                self.acc[d] += self.op_out[:, :, :, self.comp[c, d]] * \
+                    self.buf
+
+        # apply ifft, multiply by material properties and Gram
+        self.ifft()
+        for d in range(0, 3):
+            JOut[:, :, :, d] = Gram * Mr * JIn[:, :, :, d] - \
+                Mc * self.acc[d, 0:L, 0:M, 0:N]
+
+        JOut[np.invert(idx)] = 0.0
+        return out
@@ -1,5 +1,9 @@
+import numpy as np
+from numba import njit, prange
+
+
 def getOPERATOR_DDA(r, ko, refInd, kvec, Eo, nearby_quad):
-    import numpy as np
+    from vines.operators.near_field import apply_near_field
     (L, M, N, _) = r.shape
     # Self-interaction Classius-Mossotti stuff
     dx=r[1, 0, 0, 0] - r[0, 0, 0, 0]
@@ -26,11 +30,6 @@ def getOPERATOR_DDA(r, ko, refInd, kvec, Eo, nearby_quad):
     Toep = np.zeros((L,M,N,6), dtype=np.complex128)
     R0 = r[0, 0, 0, :]
 
-    n_quad = 10
-    xG, wG = np.polynomial.legendre.leggauss(n_quad)
-    XG, YG, ZG = np.meshgrid(xG, xG, xG)
-    XW, YW, ZW = np.meshgrid(wG*0.5, wG*0.5, wG*0.5)
-
     for i in range(0, L):
         for j in range(0, M):
             for k in range(0, N):
@@ -38,77 +37,81 @@ def getOPERATOR_DDA(r, ko, refInd, kvec, Eo, nearby_quad):
                 rk_to_rj = R1-R0
                 rjk = np.linalg.norm(rk_to_rj)
 
-                if nearby_quad in 'on':
-                    if rjk < 5 * dx and rjk > 1e-15:
-                        x_grid = R1[0] + dx/2 * XG
-                        y_grid = R1[1] + dx/2 * YG
-                        z_grid = R1[2] + dx/2 * ZG
-
-                        temp = np.zeros((3, 3), dtype=np.complex128)
-                        for iQ in range(0, n_quad):
-                            for jQ in range(0, n_quad):
-                                for kQ in range(0, n_quad):
-                                    RQ = np.array([x_grid[iQ, jQ, kQ],
-                                         y_grid[iQ, jQ, kQ],z_grid[iQ, jQ, kQ]])
-
-                                    rk_to_rj = RQ - R0
-
-                                    rjk = np.linalg.norm(rk_to_rj)
-                                    rjk_hat = rk_to_rj / rjk
-                                    rjkrjk = np.outer(rjk_hat, rjk_hat)
-
-                                    Ajk = np.exp(1j*ko*rjk)/rjk * \
-                                        (ko**2*(I - rjkrjk) + 
-                                        (1j*ko*rjk-1)/rjk**2*(I - 3*rjkrjk))
-                                         # Draine & Flatau
-                                    temp = temp + Ajk * XW[iQ, jQ, kQ] * YW[iQ, jQ, kQ] * ZW[iQ, jQ, kQ]
-
-                        Toep[i,j,k,0] = temp[0, 0]
-                        Toep[i,j,k,1] = temp[0, 1]
-                        Toep[i,j,k,2] = temp[0, 2]
-                        Toep[i,j,k,3] = temp[1, 1]
-                        Toep[i,j,k,4] = temp[1, 2]
-                        Toep[i,j,k,5] = temp[2, 2]
-                    else:
-                        if np.abs(rjk)>1e-15:
-                            R1 = r[i,j,k,:]
-                            rk_to_rj = R1-R0
-                            rjk = np.linalg.norm(rk_to_rj)
-                            rjk_hat = (rk_to_rj)/rjk
-                            rjkrjk = np.outer(rjk_hat, rjk_hat)
-
-                            Ajk = np.exp(1j*ko*rjk)/rjk*(ko**2*(I - rjkrjk) + 
-                                        (1j*ko*rjk-1)/rjk**2*(I - 3*rjkrjk)) 
-                            Toep[i,j,k,0] = Ajk[0, 0]
-                            Toep[i,j,k,1] = Ajk[0, 1]
-                            Toep[i,j,k,2] = Ajk[0, 2]
-                            Toep[i,j,k,3] = Ajk[1, 1]
-                            Toep[i,j,k,4] = Ajk[1, 2]
-                            Toep[i,j,k,5] = Ajk[2, 2] 
-
-
-                else:
-                    if np.abs(rjk)>1e-15:
-                        rjk_hat = (rk_to_rj)/rjk
-                        rjkrjk = np.outer(rjk_hat, rjk_hat)
-
-                        Ajk = np.exp(1j*ko*rjk)/rjk*(ko**2*(I - rjkrjk) + 
-                                    (1j*ko*rjk-1)/rjk**2*(I - 3*rjkrjk))
-                        Toep[i,j,k,0] = Ajk[0, 0]
-                        Toep[i,j,k,1] = Ajk[0, 1]
-                        Toep[i,j,k,2] = Ajk[0, 2]
-                        Toep[i,j,k,3] = Ajk[1, 1]
-                        Toep[i,j,k,4] = Ajk[1, 2]
-                        Toep[i,j,k,5] = Ajk[2, 2]
-                        
-                        
+                if np.abs(rjk)>1e-15:
+                    rjk_hat = (rk_to_rj)/rjk
+                    rjkrjk = np.outer(rjk_hat, rjk_hat)
+
+                    Ajk = np.exp(1j*ko*rjk)/rjk*(ko**2*(I - rjkrjk) + 
+                                (1j*ko*rjk-1)/rjk**2*(I - 3*rjkrjk))
+                    Toep[i,j,k,0] = Ajk[0, 0]
+                    Toep[i,j,k,1] = Ajk[0, 1]
+                    Toep[i,j,k,2] = Ajk[0, 2]
+                    Toep[i,j,k,3] = Ajk[1, 1]
+                    Toep[i,j,k,4] = Ajk[1, 2]
+                    Toep[i,j,k,5] = Ajk[2, 2]
+
+    if nearby_quad in 'on':
+        # Quadrature-corrected entries within 5 voxels of the origin
+        apply_near_field(Toep, 'dda', ko, dx)
+
     opCirculant = circulant_nop_const(Toep, L, M, N)
     op_out = fft_operator(opCirculant)
 
     return op_out, Toep, alpha_LDR
 
+@njit(parallel=True, cache=True)
+def dda_circulant_fast(ko, dx, circ):
+    ''' Fill the (2L, 2M, 2N, 6) circulant DDA kernel in place, evaluating
+    the dyadic at the signed wrapped offsets (the sign pattern of
+    gperiodic_coeff_nop follows from the offsets themselves) '''
+    (L, M, N) = (circ.shape[0] // 2, circ.shape[1] // 2, circ.shape[2] // 2)
+    for i in prange(0, 2 * L):
+        x = (i if i < L else i - 2 * L) * dx
+        for j in range(0, 2 * M):
+            y = (j if j < M else j - 2 * M) * dx
+            for k in range(0, 2 * N):
+                z = (k if k < N else k - 2 * N) * dx
+                rjk = np.sqrt(x*x + y*y + z*z)
+                if i == L or j == M or k == N or rjk < 1e-15:
+                    for p in range(0, 6):
+                        circ[i, j, k, p] = 0.0
+                    continue
+                e = np.exp(1j*ko*rjk) / rjk
+                c1 = e * ko**2
+                c2 = e * (1j*ko*rjk - 1) / rjk**2
+                hx, hy, hz = x / rjk, y / rjk, z / rjk
+                circ[i, j, k, 0] = c1 * (1 - hx*hx) + c2 * (1 - 3*hx*hx)
+                circ[i, j, k, 1] = -(c1 + 3 * c2) * hx*hy
+                circ[i, j, k, 2] = -(c1 + 3 * c2) * hx*hz
+                circ[i, j, k, 3] = c1 * (1 - hy*hy) + c2 * (1 - 3*hy*hy)
+                circ[i, j, k, 4] = -(c1 + 3 * c2) * hy*hz
+                circ[i, j, k, 5] = c1 * (1 - hz*hz) + c2 * (1 - 3*hz*hz)
+
+
+def getOPERATOR_DDA_circulant(r, ko, nearby_quad):
+    ''' FFT of the circulant DDA operator (op_out of getOPERATOR_DDA),
+    assembled directly on the (2L, 2M, 2N) periodic grid and transformed
+    in place, without the Toeplitz array or circulant_nop_const '''
+    from vines.operators.acoustic_operators import is_cubic
+    from vines.operators.near_field import apply_near_field_circulant
+    from vines.precondition.threeD import fftn_inplace_plan
+    (L, M, N, _) = r.shape
+    if not is_cubic(r):
+        # The kernel below assumes cubic voxels; op_out does not depend
+        # on the refractive index or the incident field
+        e = np.array((1.0, 0.0, 0.0))
+        return getOPERATOR_DDA(r, ko, 1.0, e, e, nearby_quad)[0]
+    dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
+
+    circ, fft_plan = fftn_inplace_plan((2 * L, 2 * M, 2 * N, 6))
+    dda_circulant_fast(np.complex128(ko), dx, circ)
+    if nearby_quad in 'on':
+        apply_near_field_circulant(circ, 'dda', ko, dx)
+    fft_plan()
+    return circ
+
+
 def gperiodic_coeff_nop(cube):
-    import numpy as np
     if  cube in 'L':
         Gp = np.array((+1.0, -1.0, -1.0, +1.0, +1.0, +1.0))
 
@@ -133,7 +136,6 @@ def gperiodic_coeff_nop(cube):
     return Gp
 
 def circulant_nop_const(Toep, L, M, N):
-    import numpy as np
     G_mn = Toep
     Gp_mn = np.zeros((2*L,2*M,2*N ,6), dtype=np.complex128)
 
@@ -172,7 +174,6 @@ def circulant_nop_const(Toep, L, M, N):
     return Gp_mn
 
 def fft_operator(A):
-    import numpy as np
     L,M,N,d = A.shape
     fA = np.zeros((L,M,N,d), dtype=np.complex128)
     # 3D-FFT of A
@@ -183,7 +184,6 @@ def fft_operator(A):
 
 
 def circulant_embed(toep, L, M, N):
-    import numpy as np
     # Circulant embedding
     circ = np.zeros((2 * L, 2 * M, 2 * N), dtype=np.complex128)
 
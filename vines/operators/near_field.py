@@ -0,0 +1,110 @@
+import numpy as np
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def near_field_geometry(n_quad=10, n_near=5):
+    ''' Quadrature geometry for the near-field correction, in units of dx.
+    For every non-negative integer offset (i, j, k) with
+    0 < i**2 + j**2 + k**2 < n_near**2 this holds the tensor Gauss-Legendre
+    nodes of the voxel centred on the offset. It depends on neither the
+    wavenumber nor the grid, so it is built once per process. '''
+    offsets = np.array([(i, j, k) for i in range(n_near)
+                        for j in range(n_near) for k in range(n_near)
+                        if 0 < i**2 + j**2 + k**2 < n_near**2])
+    xG, wG = np.polynomial.legendre.leggauss(n_quad)
+    XG, YG, ZG = np.meshgrid(xG, xG, xG, indexing='ij')
+    XW, YW, ZW = np.meshgrid(wG*0.5, wG*0.5, wG*0.5, indexing='ij')
+    nodes = np.stack((XG.ravel(), YG.ravel(), ZG.ravel()), axis=-1) / 2
+    weights = (XW * YW * ZW).ravel()
+
+    # Node positions relative to the origin voxel: (n_offsets, n_quad**3, 3)
+    rvec = offsets[:, None, :] + nodes[None, :, :]
+    rho = np.linalg.norm(rvec, axis=-1)
+    return offsets, rvec, rho, weights
+
+
+@lru_cache(maxsize=64)
+def near_field_table(kind, kdx, n_quad=10, n_near=5):
+    ''' Quadrature-corrected near-field entries for the dimensionless
+    wavenumber kdx = k * dx, one row per offset of near_field_geometry.
+
+    kind = 'potential' : integral of exp(ik|r|)/(4 pi |r|) -- scale by dx**2
+    kind = 'grad'      : its gradient, shape (n, 3)       -- scale by dx
+    kind = 'dda'       : DDA dyadic (xx, xy, xz, yy, yz, zz), shape (n, 6)
+                         -- scale by 1/dx**3
+
+    Evaluating a table costs one exponential per node and offset
+    (~10**5 for the defaults), independent of the size of the grid, and
+    the result is cached per (kind, kdx). '''
+    offsets, rvec, rho, weights = near_field_geometry(n_quad, n_near)
+    e = np.exp(1j * kdx * rho)
+    if kind in 'potential':
+        return (e / (4 * np.pi * rho)) @ weights
+    elif kind in 'grad':
+        radial = e * (1j * kdx * rho - 1) / (4 * np.pi * rho**3)
+        return np.einsum('oq,oqd,q->od', radial, rvec, weights)
+    elif kind in 'dda':
+        rhat = rvec / rho[:, :, None]
+        table = np.zeros((offsets.shape[0], 6), dtype=np.complex128)
+        c1 = e / rho * kdx**2
+        c2 = e / rho * (1j * kdx * rho - 1) / rho**2
+        for p, (a, b) in enumerate(((0, 0), (0, 1), (0, 2),
+                                    (1, 1), (1, 2), (2, 2))):
+            rr = rhat[:, :, a] * rhat[:, :, b]
+            delta = 1.0 if a == b else 0.0
+            table[:, p] = (c1 * (delta - rr) + c2 * (delta - 3 * rr)) @ \
+                weights
+        return table
+    else:
+        raise ValueError("Unknown near-field kernel '{0}'".format(kind))
+
+
+def apply_near_field(toep, kind, ko, dx, n_quad=10, n_near=5):
+    ''' Overwrite the entries of a Toeplitz array (first axes L, M, N) that
+    lie within n_near voxels of the origin with their quadrature-corrected
+    values. Modifies toep in place and returns it. '''
+    (L, M, N) = toep.shape[0:3]
+    offsets, _, _, _ = near_field_geometry(n_quad, n_near)
+    table = near_field_table(kind, complex(ko * dx), n_quad, n_near)
+    if kind in 'potential':
+        table = table * dx**2
+    elif kind in 'grad':
+        table = table * dx
+    else:
+        table = table / dx**3
+    inside = (offsets[:, 0] < L) & (offsets[:, 1] < M) & (offsets[:, 2] < N)
+    i, j, k = offsets[inside].T
+    toep[i, j, k] = table[inside]
+    return toep
+
+
+def apply_near_field_circulant(circ, kind, ko, dx, n_quad=10, n_near=5):
+    ''' As apply_near_field, but for a kernel sampled directly on the
+    (2L, 2M, 2N) periodic grid: each offset is written at all of its
+    wrapped sign images. The potential is even in every axis; for the DDA
+    dyadic the off-diagonal components change sign with the offsets. '''
+    (L, M, N) = [n // 2 for n in circ.shape[0:3]]
+    offsets, _, _, _ = near_field_geometry(n_quad, n_near)
+    table = near_field_table(kind, complex(ko * dx), n_quad, n_near)
+    if kind in 'potential':
+        table = table * dx**2
+    elif kind in 'dda':
+        table = table / dx**3
+    else:
+        raise ValueError("Unknown circulant near-field kernel '{0}'"
+                         .format(kind))
+    inside = (offsets[:, 0] < L) & (offsets[:, 1] < M) & (offsets[:, 2] < N)
+    offsets, table = offsets[inside], table[inside]
+    for sx in (1, -1):
+        for sy in (1, -1):
+            for sz in (1, -1):
+                i = (sx * offsets[:, 0]) % (2 * L)
+                j = (sy * offsets[:, 1]) % (2 * M)
+                k = (sz * offsets[:, 2]) % (2 * N)
+                if kind in 'potential':
+                    circ[i, j, k] = table
+                else:
+                    sign = np.array([1, sx * sy, sx * sz, 1, sy * sz, 1])
+                    circ[i, j, k, :] = table * sign
+    return circ
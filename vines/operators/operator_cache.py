@@ -0,0 +1,131 @@
+# Persistent on-disk cache of circulant operator spectra
+#
+# Assembling the Toeplitz operator and taking the FFT of its circulant
+# embedding is repeated, with identical inputs, across runs, convergence
+# sweeps and harmonic loops. The spectra are stored as .npy files keyed by
+# (format version, operator type, wavenumber, voxel sizes, grid shape,
+# quadrature options) and returned memory-mapped, so a cache hit costs
+# neither assembly nor RAM beyond the pages actually touched. The cache
+# directory is kept below a size bound by evicting the least recently used
+# spectra.
+#
+# The location and size bound default to the VINES_CACHE_DIR and
+# VINES_CACHE_MAX_BYTES environment variables.
+
+import os
+import hashlib
+import threading
+import numpy as np
+
+CACHE_DIR = os.environ.get(
+    'VINES_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'vines', 'operators'))
+MAX_BYTES = int(os.environ.get('VINES_CACHE_MAX_BYTES', 16 * 2**30))
+# Part of every key: bump whenever the assembly kernels or the stored
+# layout change, so that stale spectra are no longer found
+CACHE_VERSION = 2
+
+
+def grid_spacing(r):
+    ''' Voxel sizes (dx, dy, dz) of grid r (zero along an axis with a
+    single voxel) '''
+    (L, M, N, _) = r.shape
+    return (float(r[1, 0, 0, 0] - r[0, 0, 0, 0]) if L > 1 else 0.0,
+            float(r[0, 1, 0, 1] - r[0, 0, 0, 1]) if M > 1 else 0.0,
+            float(r[0, 0, 1, 2] - r[0, 0, 0, 2]) if N > 1 else 0.0)
+
+
+def operator_key(kind, ko, spacing, L, M, N, nearby_quad, octant=False):
+    ''' Hash identifying a circulant spectrum; spacing is (dx, dy, dz) as
+    returned by grid_spacing '''
+    ko = complex(ko)
+    key = repr((CACHE_VERSION, kind, ko.real, ko.imag,
+                tuple(float(d) for d in spacing), int(L), int(M), int(N),
+                nearby_quad in 'on') + (('octant',) if octant else ()))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def assemble_operator(kind, ko, r, nearby_quad='off', octant=False):
+    ''' FFT of the circulant embedding of the Toeplitz operator '''
+    from vines.operators.acoustic_operators import (
+        volume_potential, volume_potential_circulant, grad_potential)
+    from vines.precondition.threeD import (circulant_embed_octant,
+                                           circulant_gradient_embed)
+    (L, M, N, _) = r.shape
+    if kind in 'potential':
+        if octant:
+            toep = volume_potential(ko, r, nearby_quad)
+            return circulant_embed_octant(toep, L, M, N)
+        return volume_potential_circulant(ko, r, nearby_quad)
+    elif kind in 'grad':
+        toep = grad_potential(ko, r, nearby_quad)
+        return circulant_gradient_embed(toep, L, M, N)
+    else:
+        raise ValueError("Unknown operator type '{0}'".format(kind))
+
+
+def cached_operator(kind, ko, r, nearby_quad='off', octant=False,
+                    cache_dir=None, max_bytes=None):
+    ''' Circulant spectrum of the 'potential' or 'grad' operator for
+    wavenumber ko on grid r, loaded from the cache when available. The
+    returned array is a read-only memory map on a cache hit; scale the
+    input vector (e.g. Mr) rather than the spectrum to avoid a copy.
+    octant=True stores the octant-compressed potential spectrum. '''
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    (L, M, N, _) = r.shape
+    path = os.path.join(cache_dir, operator_key(kind, ko, grid_spacing(r),
+                                                L, M, N, nearby_quad,
+                                                octant) + '.npy')
+
+    if os.path.exists(path):
+        try:
+            circ_op = np.load(path, mmap_mode='r')
+            os.utime(path)  # mark as recently used
+            return circ_op
+        except (OSError, ValueError):
+            # Truncated or concurrently evicted file: rebuild it
+            pass
+
+    circ_op = assemble_operator(kind, ko, r, nearby_quad, octant)
+    if circ_op.nbytes > max_bytes:
+        return circ_op
+
+    os.makedirs(cache_dir, exist_ok=True)
+    evict(cache_dir, max_bytes - circ_op.nbytes)
+    # Write to a temporary file (per process and thread) and rename, so
+    # that concurrent readers never see a partially written spectrum
+    tmp = path + '.{0}.{1}.tmp'.format(os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        np.save(f, circ_op)
+    os.replace(tmp, path)
+    return circ_op
+
+
+def evict(cache_dir=None, max_bytes=None):
+    ''' Remove least recently used spectra until the cache holds at most
+    max_bytes '''
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear_cache(cache_dir=None):
+    ''' Remove every cached spectrum '''
+    evict(cache_dir, 0)
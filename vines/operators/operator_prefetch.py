@@ -0,0 +1,121 @@
+# Background assembly of circulant operators
+#
+# The operator of an upcoming solve (e.g. the next harmonic of a HIFU
+# cascade) depends only on its wavenumber and voxel grid, not on the
+# current field, so it can be assembled while the current solve runs.
+# OperatorPrefetcher assembles spectra through cached_operator in a
+# background worker, so finished spectra also land in the operator cache.
+#
+# The default worker is a thread, which shares the spectrum with the
+# caller directly. The assembly kernels release the GIL (nogil) and FFTW
+# releases it while transforming, so the assembly runs alongside the
+# FFT-heavy matvecs of the main thread. processes=True uses a separate
+# (spawned) process instead, isolated from the main thread's Numba and
+# FFTW thread pools; it hands the spectrum over through the cache file,
+# which the caller memory-maps, so the spectrum is shared through the
+# page cache rather than pickled between processes.
+
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numba
+import numpy as np
+from numba import njit, prange
+from vines.operators.operator_cache import (operator_key, grid_spacing,
+                                            cached_operator, CACHE_DIR,
+                                            MAX_BYTES)
+
+
+@njit(parallel=True)
+def _launch(x):
+    for i in prange(x.shape[0]):
+        x[i] = i
+
+
+def workqueue_layer():
+    ''' Whether Numba runs parallel kernels on its workqueue threading
+    layer, which aborts if two threads launch them concurrently. The
+    layer is chosen when the first parallel kernel runs, so a trivial
+    one is launched if none has run yet. '''
+    try:
+        layer = numba.threading_layer()
+    except ValueError:
+        _launch(np.zeros(1))
+        layer = numba.threading_layer()
+    return layer == 'workqueue'
+
+
+def assemble_to_cache(kind, ko, r, nearby_quad, octant, cache_dir,
+                      max_bytes):
+    ''' Assemble a spectrum into the cache (in a worker process). Returns
+    None once it is on disk, or the spectrum itself if it exceeds the
+    cache bound. '''
+    circ_op = cached_operator(kind, ko, r, nearby_quad, octant, cache_dir,
+                              max_bytes)
+    return None if circ_op.nbytes <= max_bytes else circ_op
+
+
+class OperatorPrefetcher:
+    ''' Assembles the circulant spectra of the 'potential' or 'grad'
+    operator ahead of time. prefetch(ko, r) starts the assembly in the
+    background; get(ko, r) returns the spectrum (as cached_operator),
+    waiting for a pending assembly, or assembling it now if it was never
+    prefetched.
+
+    The worker shares the process with the caller unless processes=True
+    (scripts using a worker process need the if __name__ == '__main__'
+    guard of multiprocessing).
+    With Numba's workqueue threading layer, parallel kernels must not be
+    launched from two threads at once, so in that case avoid running
+    other Numba kernels while an assembly is pending (workqueue_layer()
+    tells whether it is in use). '''
+
+    def __init__(self, kind='potential', nearby_quad='off', octant=False,
+                 processes=False, cache_dir=None, max_bytes=None):
+        self.kind = kind
+        self.nearby_quad = nearby_quad
+        self.octant = octant
+        self.cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        if processes:
+            self.executor = ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('spawn'))
+            self.task = assemble_to_cache
+        else:
+            self.executor = ThreadPoolExecutor(
+                1, thread_name_prefix='vines_prefetch')
+            self.task = cached_operator
+        self.pending = {}
+
+    def key(self, ko, r):
+        (L, M, N, _) = r.shape
+        return operator_key(self.kind, ko, grid_spacing(r), L, M, N,
+                            self.nearby_quad, self.octant)
+
+    def prefetch(self, ko, r):
+        ''' Start assembling the spectrum for wavenumber ko on grid r '''
+        key = self.key(ko, r)
+        if key not in self.pending:
+            self.pending[key] = self.executor.submit(
+                self.task, self.kind, ko, r, self.nearby_quad,
+                self.octant, self.cache_dir, self.max_bytes)
+
+    def get(self, ko, r):
+        ''' Spectrum for wavenumber ko on grid r '''
+        future = self.pending.pop(self.key(ko, r), None)
+        if future is not None:
+            circ_op = future.result()
+            if circ_op is not None:
+                return circ_op
+        return cached_operator(self.kind, ko, r, self.nearby_quad,
+                               self.octant, self.cache_dir, self.max_bytes)
+
+    def shutdown(self, wait=True):
+        ''' Stop the worker (pending assemblies still finish if wait) '''
+        self.executor.shutdown(wait=wait)
+        self.pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
@@ -0,0 +1,117 @@
+# Pruned FFTs of zero-padded arrays
+#
+# The Toeplitz matvecs transform (L, M, N) data zero-padded to (2L, 2M, 2N)
+# and keep only the first (L, M, N) octant of the inverse transform. Done as
+# a sequence of 1-D passes, the forward transform need only run along the
+# last axis over the L x M nonzero rows, then along the middle axis over
+# the first L planes, and only the final pass covers the whole array; the
+# inverse mirrors this, dropping the discarded half after every pass. This
+# is 14 rather than 24 LMN-sized 1-D passes per transform.
+#
+# The functions pruned_fftn and pruned_ifftn keep plans per thread: FFTW
+# plans are re-pointed at the arrays they transform, so sharing them
+# between threads would race. pruned_fftn transforms in the buffer of its
+# plan, so a call allocates no (2L, 2M, 2N) array.
+
+import threading
+from collections import OrderedDict
+import pyfftw
+
+# Shapes whose plans (and buffers) each thread keeps
+MAX_PLANS = 4
+_local = threading.local()
+
+
+class PrunedFFT:
+    ''' In-place pruned forward and inverse FFTs of an aligned buffer whose
+    spatial axes have even lengths (2L, 2M, 2N). The plans run on views of
+    the buffer, so no other storage is needed. forward() assumes the buffer
+    is zero outside the leading (L, M, N) block; after backward() only that
+    block holds the (normalised) inverse transform. Both accept another
+    aligned array of the same shape to transform instead of the buffer. '''
+
+    def __init__(self, buf, axes=(0, 1, 2), threads=None,
+                 flags=None):
+        if threads is None:
+            threads = pyfftw.config.NUM_THREADS
+        if flags is None:
+            flags = (pyfftw.config.PLANNER_EFFORT,)
+        self.buf = buf
+        views = []
+        for p in range(0, len(axes)):
+            # Pass p transforms axes[-1 - p] with the axes before it
+            # restricted to their leading half
+            view = [slice(None)] * buf.ndim
+            for a in axes[:len(axes) - 1 - p]:
+                view[a] = slice(0, buf.shape[a] // 2)
+            views.append((tuple(view), axes[len(axes) - 1 - p]))
+        self.forward_plans = [
+            (v, pyfftw.FFTW(buf[v], buf[v], axes=(a,),
+                            direction='FFTW_FORWARD', threads=threads,
+                            flags=flags)) for (v, a) in views]
+        self.backward_plans = [
+            (v, pyfftw.FFTW(buf[v], buf[v], axes=(a,),
+                            direction='FFTW_BACKWARD', threads=threads,
+                            flags=flags)) for (v, a) in reversed(views)]
+
+    @staticmethod
+    def _run(plans, arr):
+        for (v, plan) in plans:
+            plan(arr[v], arr[v])
+        return arr
+
+    def forward(self, arr=None):
+        return self._run(self.forward_plans,
+                         self.buf if arr is None else arr)
+
+    def backward(self, arr=None):
+        return self._run(self.backward_plans,
+                         self.buf if arr is None else arr)
+
+
+def pruned_plans(shape, axes=(0, 1, 2)):
+    ''' PrunedFFT, with its own buffer, for arrays of the given (padded)
+    shape, planned once per thread. Each thread keeps the plans of its
+    MAX_PLANS most recently used shapes. '''
+    plans = getattr(_local, 'plans', None)
+    if plans is None:
+        plans = _local.plans = OrderedDict()
+    key = (shape, axes)
+    if key in plans:
+        plans.move_to_end(key)
+    else:
+        plans[key] = PrunedFFT(pyfftw.empty_aligned(shape,
+                                                    dtype='complex128'), axes)
+        while len(plans) > MAX_PLANS:
+            plans.popitem(last=False)
+    return plans[key]
+
+
+def pruned_fftn(x, shape, axes=(0, 1, 2)):
+    ''' FFT of x zero-padded to shape along axes, skipping the 1-D
+    transforms of rows that are known to be zero. The result is the
+    buffer of the calling thread's plan, overwritten by its next
+    pruned_fftn of the same shape; copy it to keep it longer. '''
+    full = list(x.shape)
+    for (a, n) in zip(axes, shape):
+        full[a] = n
+    plans = pruned_plans(tuple(full), tuple(axes))
+    out = plans.buf
+    out[:] = 0.0
+    out[tuple(slice(0, n) for n in x.shape)] = x
+    return plans.forward(out)
+
+
+def pruned_ifftn(X, shape, axes=(0, 1, 2), overwrite_input=False):
+    ''' Leading shape block of the inverse FFT of X along axes, computing
+    only the 1-D transforms that contribute to it '''
+    if not overwrite_input or not pyfftw.is_byte_aligned(X) or \
+            not X.flags.c_contiguous or X.dtype != 'complex128':
+        Y = pyfftw.empty_aligned(X.shape, dtype='complex128')
+        Y[:] = X
+        X = Y
+    X = pruned_plans(X.shape, tuple(axes)).backward(X)
+    keep = [slice(None)] * X.ndim
+    for (a, n) in zip(axes, shape):
+        keep[a] = slice(0, n)
+    return X[tuple(keep)]
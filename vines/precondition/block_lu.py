@@ -0,0 +1,107 @@
+# Batched LU factorisation of circulant preconditioner blocks
+#
+# The 2-level circulant preconditioner is block diagonal after the FFTs,
+# with one small dense block per (x, y) frequency pair. Rather than forming
+# L*M explicit inverses, the blocks are LU-factorised in place, all at once
+# with a threaded Numba kernel, and applied by batched triangular solves.
+# The factors take the place of the blocks, so no second copy is stored.
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def lu_factor_blocks(A, piv, info):
+    ''' In-place LU factorisation with partial pivoting of every block of
+    A (n_blocks, n, n); row interchanges are recorded in piv. As LAPACK's
+    getrf, info[b] is 0 or, if block b is singular, k + 1 for its first
+    zero pivot U[k, k], after which that block is left unfinished. '''
+    (nb, n, _) = A.shape
+    for b in prange(0, nb):
+        info[b] = 0
+        for k in range(0, n):
+            p = k
+            amax = abs(A[b, k, k])
+            for i in range(k + 1, n):
+                if abs(A[b, i, k]) > amax:
+                    amax = abs(A[b, i, k])
+                    p = i
+            piv[b, k] = p
+            if p != k:
+                for j in range(0, n):
+                    temp = A[b, k, j]
+                    A[b, k, j] = A[b, p, j]
+                    A[b, p, j] = temp
+            d = A[b, k, k]
+            if d == 0:
+                info[b] = k + 1
+                break
+            for i in range(k + 1, n):
+                A[b, i, k] /= d
+                l_ik = A[b, i, k]
+                for j in range(k + 1, n):
+                    A[b, i, j] -= l_ik * A[b, k, j]
+
+
+@njit(parallel=True, cache=True)
+def lu_solve_blocks(LU, piv, x):
+    ''' In-place solve of every block system with the factors of
+    lu_factor_blocks; x has shape (n_blocks, n) '''
+    (nb, n, _) = LU.shape
+    for b in prange(0, nb):
+        for k in range(0, n):
+            p = piv[b, k]
+            if p != k:
+                temp = x[b, k]
+                x[b, k] = x[b, p]
+                x[b, p] = temp
+        for i in range(1, n):
+            s = x[b, i]
+            for j in range(0, i):
+                s -= LU[b, i, j] * x[b, j]
+            x[b, i] = s
+        for i in range(n - 1, -1, -1):
+            s = x[b, i]
+            for j in range(i + 1, n):
+                s -= LU[b, i, j] * x[b, j]
+            x[b, i] = s / LU[b, i, i]
+
+
+def circ2_factor(circ2, contrast=None, overwrite=False):
+    ''' LU factors of the blocks I - contrast * circ2 (or of the blocks of
+    circ2 themselves when contrast is None), for a stack of any leading
+    shape (..., n, n). contrast is a scalar or, for a contrast varying
+    along the blocks, an array (..., n) scaling their rows, i.e. the blocks
+    I - diag(contrast) circ2. With overwrite=True the factors replace
+    circ2. Returns (LU, piv) for circ2_solve; raises LinAlgError if a
+    block is singular. '''
+    n = circ2.shape[-1]
+    if contrast is None:
+        A = circ2 if overwrite else circ2.copy()
+    else:
+        A = circ2 if overwrite else np.empty_like(circ2)
+        np.multiply(circ2, -np.asarray(contrast)[..., None], out=A)
+        A[..., np.arange(n), np.arange(n)] += 1.0
+    A = np.ascontiguousarray(A, dtype=np.complex128)
+    LU = A.reshape(-1, n, n)
+    piv = np.empty(LU.shape[0:2], dtype=np.int64)
+    info = np.empty(LU.shape[0], dtype=np.int64)
+    lu_factor_blocks(LU, piv, info)
+    if np.any(info):
+        raise np.linalg.LinAlgError(
+            'Singular matrix: {0} of the blocks'.format(
+                np.count_nonzero(info)))
+    return A, piv.reshape(A.shape[:-1])
+
+
+def circ2_solve(factors, x, overwrite=False):
+    ''' Apply the inverse of every factorised block to x (..., n), whose
+    leading shape matches that of the blocks '''
+    LU, piv = factors
+    n = LU.shape[-1]
+    y = x if overwrite and x.flags.c_contiguous and \
+        x.dtype == np.complex128 else \
+        np.array(x, dtype=np.complex128, order='C')
+    lu_solve_blocks(LU.reshape(-1, n, n), piv.reshape(-1, n),
+                    y.reshape(-1, n))
+    return y
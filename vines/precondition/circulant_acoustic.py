@@ -1,100 +1,201 @@
 # Circulant acoustic
-def circ_1_level_acoustic(Toep, L, M, N, on_off):
+def circulant_average(A, sign=1):
+    ''' T. Chan's optimal circulant average along the first axis of a
+    stack of Toeplitz generators: c[i] = sign (n-i)/n A[i] + i/n A[n-i]
+    for i > 0 and c[0] = A[0]. sign = -1 for generators that are odd in
+    this axis. '''
     import numpy as np
-    from scipy.linalg import toeplitz
-    # Create 1-level circulant approximation to Toeplitz operator
-    circ_L_opToep = np.zeros((L, M, N), dtype=np.complex128)
+    n = A.shape[0]
+    w = (np.arange(n) / n).reshape((n,) + (1,) * (A.ndim - 1))
+    c = sign * (1 - w) * A + w * A[(-np.arange(n)) % n]
+    c[0] = A[0]
+    return c
 
-    A = Toep
 
-    #  Now construct circulant approximation
-    c1 = np.zeros((L, M, N), dtype=np.complex128)
+def toeplitz_gather(n):
+    ''' Index |a - b| and sign (-1 below the diagonal) of every entry of
+    an n x n Toeplitz block, for filling stacks of blocks at once '''
+    import numpy as np
+    a = np.arange(n)
+    diff = a[:, None] - a[None, :]
+    return np.abs(diff), np.where(diff > 0, -1, 1)
 
-    for i in range(1, L):
-        c1[i, :, :] = (L - i)/L * A[i, :, :] + i/L * A[(L-1)-i+1, :, :]
-    # from IPython import embed; embed()
-    # Fix up for 1st element
-    c1[0, :, :] = A[0, :, :]
-    c1_fft = np.fft.fft(c1.T).T
+
+def circ_1_level_acoustic(Toep, L, M, N, on_off):
+    import numpy as np
+    # Create 1-level circulant approximation to Toeplitz operator
+    c1_fft = np.fft.fft(circulant_average(Toep), axis=0)
     circ_L_opToep = c1_fft
 
     if (on_off in 'on'):
-        # Construct 1-level preconditioner
-        circ = np.zeros((L, M*N, M*N), dtype=np.complex128)
-        for i_loop in range(0, L):
-            temp = np.zeros((M*N, M*N), dtype=np.complex128)
-            chan = np.zeros((N, M, M), dtype=np.complex128)
-            # First block
-            for i in range(0, N):
-                chan[i, :, :] = toeplitz(c1_fft[i_loop, 0:M, i], c1_fft[i_loop, 0:M, i])
-
-            result = chan[toeplitz(np.arange(0, N))].transpose(0, 2, 1, 3).reshape(M*N, M*N).copy()
-            temp[0:M*N, 0:M*N] = result
-
-            circ[i_loop, :, :] = temp
+        # Construct 1-level preconditioner: block (p, q) of slice l is the
+        # M x M Toeplitz matrix of c1_fft[l, :, |p - q|]
+        iM, _ = toeplitz_gather(M)
+        iN, _ = toeplitz_gather(N)
+        circ = c1_fft[:, iM[None, :, None, :], iN[:, None, :, None]]
+        circ = circ.reshape(L, M*N, M*N)
     else:
         circ = 0
-        
+
     return circ, circ_L_opToep
 
-    
+
+def circ_2_level_acoustic_gen(circ_L_opToep):
+    import numpy as np
+    # Circulant approximation along y of every x-slice: c1_fft[l, m] is the
+    # first column of the symmetric N x N Toeplitz block of the (x, y)
+    # frequency pair (l, m)
+    return np.fft.fft(circulant_average(circ_L_opToep.transpose(1, 0, 2)),
+                      axis=0).transpose(1, 0, 2)
+
+
 def circ_2_level_acoustic(circ_L_opToep, L, M, N):
+    # N x N Toeplitz block of every (x, y) frequency pair
+    c1_fft = circ_2_level_acoustic_gen(circ_L_opToep)
+    iN, _ = toeplitz_gather(N)
+    circ2 = c1_fft[:, :, iN]
+
+    return circ2, circ_L_opToep
+
+
+# Matrix-vector product with 2-level circulant preconditioner. The x and y
+# levels are whole-array FFTs and the (L, M) block products along z one
+# batched matmul.
+def mvp_circ2_acoustic(JInVec, circ2_inv, L, M, N, idx):
     import numpy as np
-    from scipy.linalg import toeplitz
-    circ_M_opToep = np.zeros((L, M, N), dtype=np.complex128)
+    V_R = JInVec.reshape(L, M, N, order='F')
+    V_R[np.invert(idx)] = 0.0
+
+    temp = np.fft.fft2(V_R, axes=(0, 1))
+    temp = np.matmul(circ2_inv, temp[:, :, :, None])[:, :, :, 0]
+    temp = np.fft.ifft2(temp, axes=(0, 1))
 
-    circ2 = np.zeros((L, M, N, N), dtype=np.complex128)
+    temp[np.invert(idx)] = 0.0 + 0j
+    matvec = temp.reshape(L*M*N, 1, order='F')
+    return matvec
 
-    for i_loop in range(0, L):
-        # FIX ME: Don't need to create new A-F arrays, get rid of them
-        A = circ_L_opToep[i_loop, :, :]
 
-        c1 = np.zeros((M, N), dtype=np.complex128)
+def circ2_eig_acoustic(circ2):
+    ''' Eigendecomposition circ2 = Q diag(lam) Q^-1 of every block of the
+    2-level circulant approximation (any stack of blocks, shape
+    (..., N, N)). It does not depend on the contrast, so it is computed
+    once and reused for every refractive index. '''
+    import numpy as np
+    lam, Q = np.linalg.eig(circ2)
+    return lam, Q, np.linalg.inv(Q)
 
-        for i in range(1, M):
-            c1[i, :] =  (M - i)/M * A[i, :] + i/M * A[(M-1)-i+1, :]
 
-        c1[0, :] = A[0, :]
+def circ2_inv_from_eig(circ2_eig, contrast):
+    ''' Blocks (I - contrast * circ2)^-1 from the eigendecomposition, for
+    use with mvp_circ2_acoustic '''
+    import numpy as np
+    lam, Q, Q_inv = circ2_eig
+    return np.matmul(Q / (1 - contrast * lam)[..., None, :], Q_inv)
 
-        c1_fft = np.fft.fft(c1, axis=0)
 
-        circ_M_opToep[i_loop, :, :] = c1_fft
+# Matrix-vector product with 2-level circulant preconditioner, with the
+# inverse blocks applied as a diagonal scaling in their eigenbasis
+def mvp_circ2_acoustic_eig(JInVec, circ2_eig, contrast, L, M, N, idx):
+    import numpy as np
+    lam, Q, Q_inv = circ2_eig
+    V_R = JInVec.reshape(L, M, N, order='F')
+    V_R[np.invert(idx)] = 0.0
 
-        for j_loop in range(0, M):
-            temp = np.zeros((N, N), dtype=np.complex128)
+    # Transform along x and y; the blocks act along z
+    temp = np.fft.fft(np.fft.fft(V_R, axis=0), axis=1)
+    temp = np.matmul(Q_inv, temp[:, :, :, None])[:, :, :, 0]
+    temp /= 1 - contrast * lam
+    temp = np.matmul(Q, temp[:, :, :, None])[:, :, :, 0]
+    temp = np.fft.ifft(np.fft.ifft(temp, axis=1), axis=0)
 
-            # First block
-            temp[0:N, 0:N] = toeplitz(c1_fft[j_loop, 0:N], c1_fft[j_loop, 0:N])
+    temp[np.invert(idx)] = 0.0 + 0j
+    matvec = temp.reshape(L*M*N, 1, order='F')
+    return matvec
 
-            circ2[i_loop, j_loop, :, :] = temp
 
-    return circ2, circ_L_opToep
+# Matrix-vector product with 2-level circulant preconditioner, with the
+# blocks applied through their LU factors (see block_lu.circ2_factor)
+def mvp_circ2_acoustic_lu(JInVec, circ2_lu, L, M, N, idx):
+    import numpy as np
+    from vines.precondition.block_lu import circ2_solve
+    V_R = JInVec.reshape(L, M, N, order='F')
+    V_R[np.invert(idx)] = 0.0
 
+    # Transform along x and y; the blocks act along z
+    temp = np.fft.fft(np.fft.fft(V_R, axis=0), axis=1)
+    temp = circ2_solve(circ2_lu, temp, overwrite=True)
+    temp = np.fft.ifft(np.fft.ifft(temp, axis=1), axis=0)
 
-# Matrix-vector product with 2-level circulant preconditioner
-def mvp_circ2_acoustic(JInVec, circ2_inv, L, M, N, idx):
+    temp[np.invert(idx)] = 0.0 + 0j
+    matvec = temp.reshape(L*M*N, 1, order='F')
+    return matvec
+
+
+# Matrix-vector product with 2-level circulant preconditioner, with the
+# Toeplitz blocks inverted through their Gohberg-Semencul generators (see
+# toeplitz_inverse.gs_factor applied to circ_2_level_acoustic_gen). No
+# N x N block is ever formed.
+def mvp_circ2_acoustic_gs(JInVec, circ2_gs, L, M, N, idx):
     import numpy as np
+    from vines.precondition.toeplitz_inverse import gs_solve
     V_R = JInVec.reshape(L, M, N, order='F')
-    V_R[np.invert(idx)] = 0.0 
-    
-    Vrhs = V_R.reshape(L*M*N, 1, order='F')
+    V_R[np.invert(idx)] = 0.0
 
-    temp = Vrhs.reshape(L,M*N, order='F')
-    temp = np.fft.fft(temp, axis=0).T  # transpose is application of permutation matrix
+    # Transform along x and y; the blocks act along z
+    temp = np.fft.fft(np.fft.fft(V_R, axis=0), axis=1)
+    temp = gs_solve(circ2_gs, temp)
+    temp = np.fft.ifft(np.fft.ifft(temp, axis=1), axis=0)
 
-    for i in range(0, L):
-        TEMP = temp[:, i].reshape(M,N, order='F')
-        TEMP = np.fft.fft(TEMP, axis=0).T
-        for j in range(0, M):
-            TEMP[:,j] = np.matmul(circ2_inv[i, j, :, :], TEMP[:, j])
+    temp[np.invert(idx)] = 0.0 + 0j
+    matvec = temp.reshape(L*M*N, 1, order='F')
+    return matvec
 
-        TEMP = np.fft.ifft(TEMP.T, axis=0)
-        temp[:, i] = TEMP.reshape(1,M*N, order='F')
 
+def circ2_contrast_profile(Mr, idx, axis=2):
+    ''' Contrast of Mr averaged over the scatterer voxels of every plane
+    normal to axis (zero for planes that miss the scatterer) '''
+    import numpy as np
+    other = tuple(a for a in range(0, 3) if a != axis)
+    count = np.sum(idx, axis=other)
+    total = np.sum(np.where(idx, Mr, 0.0), axis=other)
+    return total / np.maximum(count, 1)
+
+
+def circ2_variable_acoustic(toep, Mr, idx, axis=2):
+    ''' 2-level circulant preconditioner for an inhomogeneous scatterer,
+    with operator I - Mr T for the Toeplitz operator toep (so that Mr and
+    toep carry the k^2 factor between them as in the matvec). The blocks
+    act along axis and are I - diag(c) circ2 for the contrast profile c of
+    Mr along that axis, which is exact for media layered normal to axis
+    and averages the contrast over each plane otherwise; choose the axis
+    along which the contrast varies most. The blocks are factorised in
+    one batched call (block_lu.circ2_factor). For use with
+    mvp_circ2_acoustic_var. '''
+    from vines.precondition.block_lu import circ2_factor
+    perm = [a for a in range(0, 3) if a != axis] + [axis]
+    T = toep.transpose(perm)
+    (L, M, N) = T.shape
+    _, circ_L_opToep = circ_1_level_acoustic(T, L, M, N, 'off')
+    circ2, _ = circ_2_level_acoustic(circ_L_opToep, L, M, N)
+    contrast = circ2_contrast_profile(Mr, idx, axis)
+    return circ2_factor(circ2, contrast, overwrite=True), axis
+
+
+# Matrix-vector product with the variable-contrast 2-level circulant
+# preconditioner of circ2_variable_acoustic
+def mvp_circ2_acoustic_var(JInVec, circ2_var, L, M, N, idx):
+    import numpy as np
+    from vines.precondition.block_lu import circ2_solve
+    circ2_lu, axis = circ2_var
+    perm = [a for a in range(0, 3) if a != axis] + [axis]
+    V_R = JInVec.reshape(L, M, N, order='F')
+    V_R[np.invert(idx)] = 0.0
+
+    # Transform across the blocks' axis; the blocks act along it
+    temp = np.fft.fft2(V_R.transpose(perm), axes=(0, 1))
+    temp = circ2_solve(circ2_lu, temp, overwrite=True)
+    temp = np.fft.ifft2(temp, axes=(0, 1)).transpose(np.argsort(perm))
 
-    temp = np.fft.ifft(temp.T, axis=0)  # transpose is application of permutation matrix transpose
-    TEMP = temp.reshape(L*M*N,1, order='F')
-    TEMP_RO = TEMP.reshape(L, M, N, order='F')
-    TEMP_RO[np.invert(idx)] = 0.0 +0j 
-    matvec = TEMP_RO.reshape(L*M*N, 1, order='F')
-    return matvec
\ No newline at end of file
+    temp[np.invert(idx)] = 0.0 + 0j
+    matvec = temp.reshape(L*M*N, 1, order='F')
+    return matvec
@@ -96,9 +96,8 @@ def circulant_embed(toep, L, M, N):
 def circulant_embed_fftw(toep, L, M, N):
     import numpy as np
     import pyfftw
-    import multiprocessing
-    pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
-    pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
+    from vines.operators.fftw_wisdom import configure
+    configure()
     # Circulant embedding
     circ = np.zeros((2 * L, 2 * M, 2 * N), dtype=np.complex128)
 
@@ -116,10 +115,49 @@ def circulant_embed_fftw(toep, L, M, N):
     return circ_op
 
 
+def fftn_inplace_plan(shape, axes=(0, 1, 2)):
+    ''' SIMD-aligned complex array and an in-place forward FFTW plan over
+    the given axes. Planning may overwrite the array, so fill it only after
+    this call and then run plan(). '''
+    import pyfftw
+    from vines.operators.fftw_wisdom import configure
+    configure()
+    a = pyfftw.empty_aligned(shape, dtype='complex128')
+    plan = pyfftw.FFTW(a, a, axes=axes,
+                       threads=pyfftw.config.NUM_THREADS,
+                       flags=(pyfftw.config.PLANNER_EFFORT,))
+    return a, plan
+
+
+def circulant_embed_octant(toep, L, M, N):
+    ''' Octant-compressed FFT of the circulant embedding.
+    The embedded kernel is even in every axis, so its DFT is even too and
+    is determined by the (L+1, M+1, N+1) values computed here with a
+    type-I DCT (one eighth of the memory of circulant_embed). The matvecs
+    in vines.operators.acoustic_matvecs accept either representation. '''
+    import numpy as np
+    from scipy.fft import dctn
+    circ = np.zeros((L + 1, M + 1, N + 1), dtype=np.complex128)
+    circ[0:L, 0:M, 0:N] = toep
+    circ_op = dctn(circ, type=1, overwrite_x=True, workers=-1)
+    return circ_op
+
+
+def octant_expand(circ_op):
+    ''' Full (2L, 2M, 2N) spectrum from its octant-compressed form '''
+    import numpy as np
+    (L, M, N) = [n - 1 for n in circ_op.shape]
+    ix = np.r_[0:L + 1, L - 1:0:-1]
+    iy = np.r_[0:M + 1, M - 1:0:-1]
+    iz = np.r_[0:N + 1, N - 1:0:-1]
+    return circ_op[np.ix_(ix, iy, iz)]
+
+
 def fftw_operator(A):
     import numpy as np
-    import pyfftw, multiprocessing
-    pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
+    import pyfftw
+    from vines.operators.fftw_wisdom import configure
+    configure()
     L, M, N, d = A.shape
     fA = np.zeros((L, M, N, d), dtype=np.complex128)
     # 3D-FFT of A
@@ -0,0 +1,73 @@
+# Inverses of symmetric Toeplitz blocks through Gohberg-Semencul generators
+#
+# The blocks of the 2-level circulant preconditioner are N x N symmetric
+# Toeplitz matrices, each determined by its first column. Storing them (or
+# their inverses) densely costs L*M*N^2 numbers. For a symmetric Toeplitz T
+# with x = T^-1 e_0 and u = Z J x (x reversed, shifted down by one),
+#
+#     T^-1 = ( L(x) L(x)^T - L(u) L(u)^T ) / x_0,
+#
+# with L(v) the lower triangular Toeplitz matrix of first column v
+# (Gohberg & Semencul, 1972). x follows from the Levinson recursion, and
+# the triangular Toeplitz products are convolutions done with FFTs of
+# length 2N. Only the spectra of x and u are kept: O(LMN) memory.
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def levinson_blocks(t, x):
+    ''' First column x[b] of the inverse of the symmetric Toeplitz matrix
+    with first column t[b], for every block b of t (n_blocks, n). Levinson
+    recursion, O(n^2) per block; it needs nonsingular leading minors. '''
+    (nb, n) = t.shape
+    for b in prange(0, nb):
+        x[b, 0] = 1.0 / t[b, 0]
+        for k in range(1, n):
+            x[b, k] = 0.0
+        for m in range(1, n):
+            # Error of [x; 0] in the last row of the order m + 1 system
+            eps = 0.0j
+            for i in range(0, m):
+                eps += t[b, m - i] * x[b, i]
+            # x <- ([x; 0] - eps [0; J x]) / (1 - eps^2)
+            d = 1.0 / (1.0 - eps * eps)
+            for i in range(0, (m + 2) // 2):
+                lo = x[b, i]
+                hi = x[b, m - i]
+                x[b, i] = (lo - eps * hi) * d
+                x[b, m - i] = (hi - eps * lo) * d
+
+
+def gs_factor(gen, contrast=None):
+    ''' Gohberg-Semencul generators of the inverses of the symmetric
+    Toeplitz blocks I - contrast * T(gen) (or T(gen) when contrast is None)
+    for generating vectors gen (..., N), i.e. first columns. Returns the
+    length-2N spectra of x and u and 1 / x_0, for gs_solve. '''
+    n = gen.shape[-1]
+    if contrast is None:
+        t = np.array(gen, dtype=np.complex128)
+    else:
+        t = -contrast * gen.astype(np.complex128)
+        t[..., 0] += 1.0
+    t = np.ascontiguousarray(t)
+    x = np.empty_like(t)
+    levinson_blocks(t.reshape(-1, n), x.reshape(-1, n))
+    u = np.zeros_like(x)
+    u[..., 1:] = x[..., :0:-1]
+    return np.fft.fft(x, 2 * n), np.fft.fft(u, 2 * n), 1.0 / x[..., 0:1]
+
+
+def gs_solve(gs, v):
+    ''' Apply the inverse of every block to v (..., N), whose leading shape
+    matches that of the blocks '''
+    fx, fu, x0_inv = gs
+    n = v.shape[-1]
+    # L(a)^T v = J L(a) J v: one transform of J v serves both terms
+    fv = np.fft.fft(v[..., ::-1], 2 * n)
+    wx = np.fft.ifft(fx * fv)[..., n - 1::-1]
+    wu = np.fft.ifft(fu * fv)[..., n - 1::-1]
+    w = np.fft.ifft(fx * np.fft.fft(wx, 2 * n) -
+                    fu * np.fft.fft(wu, 2 * n))
+    return x0_inv * w[..., 0:n]
@@ -0,0 +1,172 @@
+# Two-grid preconditioner on a coarsened voxel grid
+#
+# The circulant preconditioners capture the operator well for the high
+# spatial frequencies of the error but miss the smooth, domain-wide ones
+# that the scatterer's shape and contrast variations introduce, so GMRES
+# iteration counts grow as the grid is refined (nPerLam 10-15). A
+# two-grid preconditioner deals with those on a grid with twice the voxel
+# size: residuals are restricted by averaging over 2 x 2 x 2 cells, the
+# coarse VIE is solved approximately with the FFT matvec, and the
+# correction is prolonged back by piecewise-constant interpolation. The
+# variable-contrast circulant preconditioner then smooths the remaining
+# fine-grid residual:
+#
+#     x = P Ac^-1 R r,  x += S (r - A x)
+#
+# The coarse solve is a fixed number of circulant-preconditioned GMRES
+# steps, which depend nonlinearly on r, so the outer solver must be a
+# flexible one (vines.solvers.fgmres). For small coarse scatterers
+# coarse='direct' factorises the dense coarse matrix instead, which gives
+# a fixed linear preconditioner for any outer solver.
+
+import numpy as np
+import scipy.linalg
+from scipy.sparse.linalg import LinearOperator
+from vines.geometry.geometry import grid3d
+from vines.operators.acoustic_operators import volume_potential
+from vines.operators.acoustic_matvecs import CirculantMatvec
+from vines.precondition.threeD import circulant_embed_fftw
+from vines.precondition.circulant_acoustic import (circ2_variable_acoustic,
+                                                   mvp_circ2_acoustic_var)
+from vines.solvers.fgmres import fgmres
+
+
+def coarse_grid(r):
+    ''' Voxel grid with twice the voxel size of r, each coarse voxel
+    covering a 2 x 2 x 2 cell of fine voxels (cells at the far faces of
+    odd-sized grids are truncated) '''
+    dx = r[1, 0, 0, 0] - r[0, 0, 0, 0]
+    (L, M, N, _) = r.shape
+    x = r[0, 0, 0, 0] + dx / 2 + 2 * dx * np.arange(0, (L + 1) // 2)
+    y = r[0, 0, 0, 1] + dx / 2 + 2 * dx * np.arange(0, (M + 1) // 2)
+    z = r[0, 0, 0, 2] + dx / 2 + 2 * dx * np.arange(0, (N + 1) // 2)
+    rc, _, _, _ = grid3d(x, y, z)
+    return rc
+
+
+def restrict(x):
+    ''' Average of an (L, M, N) array over the 2 x 2 x 2 cells of the
+    coarse grid '''
+    (L, M, N) = x.shape
+    (Lc, Mc, Nc) = ((L + 1) // 2, (M + 1) // 2, (N + 1) // 2)
+    xp = np.zeros((2 * Lc, 2 * Mc, 2 * Nc), dtype=x.dtype)
+    xp[0:L, 0:M, 0:N] = x
+    return xp.reshape(Lc, 2, Mc, 2, Nc, 2).mean(axis=(1, 3, 5))
+
+
+def prolong(xc, L, M, N):
+    ''' Piecewise-constant interpolation of a coarse array to the fine
+    (L, M, N) grid '''
+    x = np.repeat(np.repeat(np.repeat(xc, 2, axis=0), 2, axis=1), 2, axis=2)
+    return x[0:L, 0:M, 0:N]
+
+
+def dense_vie(toep, Mr, idx, block=512):
+    ''' Dense matrix of (I - Mr T) on the voxels idx, from the Toeplitz
+    array toep of T, assembled in blocks of rows '''
+    (ii, jj, kk) = np.nonzero(idx)
+    n = ii.shape[0]
+    A = np.empty((n, n), dtype=np.complex128)
+    for start in range(0, n, block):
+        rows = slice(start, min(start + block, n))
+        A[rows] = toep[np.abs(ii[rows, None] - ii[None, :]),
+                       np.abs(jj[rows, None] - jj[None, :]),
+                       np.abs(kk[rows, None] - kk[None, :])]
+        A[rows] *= -Mr[ii[rows], jj[rows], kk[rows], None]
+    A[np.diag_indices(n)] += 1.0
+    return A
+
+
+class TwoGridPreconditioner:
+    ''' Two-grid preconditioner for the acoustic VIE (I - ko^2 Mr T) u = f
+    on the voxel grid r with scatterer voxels idx. It has shape and
+    matvec, so it can be passed as M to fgmres (or to scipy's gmres with
+    coarse='direct').
+
+    coarse='fft' approximates the coarse solve by coarse_iters GMRES
+    steps from zero with the coarse FFT matvec, right-preconditioned by
+    the coarse circulant preconditioner; use a flexible outer solver.
+    coarse='direct' solves the coarse system with an LU factorisation of
+    its dense matrix on the coarse scatterer voxels, built once (16 n^2
+    bytes and O(n^3) work for n coarse scatterer voxels, so only for
+    small problems). axis is the axis of the circulant blocks (see
+    circ2_variable_acoustic). '''
+
+    def __init__(self, ko, r, Mr, idx, axis=2, coarse='fft',
+                 coarse_iters=10):
+        if coarse not in ('fft', 'direct'):
+            raise ValueError("coarse must be 'fft' or 'direct'")
+        (L, M, N, _) = r.shape
+        (self.L, self.M, self.N) = (L, M, N)
+        self.shape = (L * M * N, L * M * N)
+        self.dtype = np.dtype(np.complex128)
+        self.idx = idx
+        self.Mr = ko**2 * Mr
+        self.coarse = coarse
+        self.coarse_iters = coarse_iters
+
+        # Coarse grid: volume-averaged contrast, scatterer wherever a cell
+        # holds a fine scatterer voxel
+        rc = coarse_grid(r)
+        (Lc, Mc, Nc, _) = rc.shape
+        self.coarse_shape = (Lc, Mc, Nc)
+        self.idx_c = restrict(idx.astype(np.float64)) > 0
+        self.Mr_c = restrict(np.where(idx, self.Mr, 0.0))
+        toep_c = volume_potential(ko, rc)
+        if coarse == 'direct':
+            self.lu_c = scipy.linalg.lu_factor(
+                dense_vie(toep_c, self.Mr_c, self.idx_c), overwrite_a=True)
+        else:
+            matvec_c = CirculantMatvec(
+                circulant_embed_fftw(toep_c, Lc, Mc, Nc), Lc, Mc, Nc)
+            prec_c = circ2_variable_acoustic(toep_c, self.Mr_c, self.idx_c,
+                                             axis)
+            n_c = Lc * Mc * Nc
+            self.A_c = LinearOperator(
+                (n_c, n_c), dtype=np.complex128,
+                matvec=lambda x: matvec_c.vec(x.copy(), self.idx_c,
+                                              self.Mr_c))
+            self.M_c = LinearOperator(
+                (n_c, n_c), dtype=np.complex128,
+                matvec=lambda x: mvp_circ2_acoustic_var(
+                    x.copy(), prec_c, Lc, Mc, Nc, self.idx_c))
+        del toep_c
+
+        # Fine grid: smoother and operator, both from one assembly of the
+        # Toeplitz array
+        toep = volume_potential(ko, r)
+        self.smoother = circ2_variable_acoustic(toep, self.Mr, idx, axis)
+        self.fine = CirculantMatvec(circulant_embed_fftw(toep, L, M, N),
+                                    L, M, N)
+        del toep
+
+    def smooth(self, res):
+        ''' Circulant preconditioner applied to a fine residual '''
+        (L, M, N) = (self.L, self.M, self.N)
+        return mvp_circ2_acoustic_var(res.copy(), self.smoother, L, M, N,
+                                      self.idx)
+
+    def coarse_correction(self, res):
+        ''' Prolonged coarse-grid solution for the restricted residual '''
+        (L, M, N) = (self.L, self.M, self.N)
+        (Lc, Mc, Nc) = self.coarse_shape
+        res_c = restrict(res.reshape(L, M, N, order='F'))
+        res_c[np.invert(self.idx_c)] = 0.0
+        if self.coarse == 'direct':
+            e_c = np.zeros((Lc, Mc, Nc), dtype=np.complex128)
+            e_c[self.idx_c] = scipy.linalg.lu_solve(self.lu_c,
+                                                    res_c[self.idx_c])
+        else:
+            e_c, _ = fgmres(self.A_c, res_c.reshape(-1, order='F'),
+                            M=self.M_c, tol=0.0, restart=self.coarse_iters,
+                            maxiter=1)
+            e_c = e_c.reshape(Lc, Mc, Nc, order='F')
+        e = prolong(e_c, L, M, N)
+        e[np.invert(self.idx)] = 0.0
+        return e.reshape(L * M * N, 1, order='F')
+
+    def matvec(self, res):
+        res = np.asarray(res).reshape(-1, 1)
+        x = self.coarse_correction(res)
+        Ax = self.fine.vec(x.copy(), self.idx, self.Mr)
+        return x + self.smooth(res - Ax)
@@ -0,0 +1,139 @@
+# Block GMRES for many right-hand sides
+#
+# Scattering of many incident fields by one object (a sweep over incidence
+# directions, orientation averaging, reduced-order models) leads to one
+# operator and a block of right-hand sides. Block GMRES builds a single
+# Krylov space from all of them, so that each iteration costs one batched
+# matvec (e.g. mvp_vec_fftw_block) and every column benefits from the
+# directions contributed by the others.
+#
+# Two kinds of deflation keep the block small:
+# * directions of a new Arnoldi block that are (numerically) linearly
+#   dependent on the existing basis are dropped, which is common for plane
+#   waves with nearby directions;
+# * columns that have converged are removed from the block at each restart.
+
+import numpy as np
+import scipy.linalg
+from scipy.sparse.linalg import aslinearoperator
+
+
+def _rank_revealing_qr(W, tol):
+    ''' W = Q R with the columns of Q spanning the numerical range of W.
+    Directions with |R_ii| <= tol * scale are dropped. '''
+    Q, R, perm = scipy.linalg.qr(W, mode='economic', pivoting=True)
+    d = np.abs(np.diag(R))
+    scale = max(d[0] if d.size else 0.0, tol)
+    rank = int(np.sum(d > tol * scale))
+    R = R[:rank, np.argsort(perm)]
+    return Q[:, :rank], R
+
+
+def block_gmres(A, B, M=None, x0=None, tol=1e-5, restart=20, maxiter=None,
+                callback=None, deflation_tol=1e-10):
+    ''' Solve A X = B for a block of right-hand sides B (n, n_rhs).
+
+    A and the (right) preconditioner M may be LinearOperators or matrices;
+    their matmat is applied to whole blocks, so they should implement it
+    (e.g. LinearOperator(..., matmat=...) around mvp_vec_fftw_block).
+    Column i has converged when ||b_i - A x_i|| <= tol * ||b_i||.
+    restart is the number of block steps per cycle and maxiter the maximum
+    number of cycles. callback, if given, is called after every block step
+    with the relative residual norms of all columns.
+
+    Returns (X, info) with info = 0 on convergence, otherwise the number of
+    cycles performed. '''
+    A = aslinearoperator(A)
+    M = None if M is None else aslinearoperator(M)
+    B = np.asarray(B)
+    if B.ndim == 1:
+        B = B[:, None]
+    (n, n_rhs) = B.shape
+    dtype = np.result_type(A.dtype, B.dtype, np.complex128)
+    X = np.zeros((n, n_rhs), dtype=dtype) if x0 is None else \
+        np.array(x0, dtype=dtype).reshape(n, n_rhs)
+    maxiter = 10 * n if maxiter is None else maxiter
+
+    bnorm = np.linalg.norm(B, axis=0)
+    bnorm[bnorm == 0] = 1.0
+    R = B - A.matmat(X) if x0 is not None else B.astype(dtype)
+    res = np.linalg.norm(R, axis=0) / bnorm
+
+    for cycle in range(0, maxiter):
+        # Deflate converged columns: only the others enter the new cycle
+        active = np.flatnonzero(res > tol)
+        if active.size == 0:
+            return X, 0
+        V0, S = _rank_revealing_qr(R[:, active], deflation_tol)
+        p = V0.shape[1]
+        if p == 0:
+            return X, 0
+
+        # Krylov basis, least-squares system and its QR factorisation.
+        # H is reduced to triangular form block by block; the orthogonal
+        # factors of each step are kept to be applied to later blocks.
+        basis = [V0]
+        H = np.zeros((p * (restart + 1), p * restart), dtype=dtype)
+        G = np.zeros((p * (restart + 1), active.size), dtype=dtype)
+        G[0:p] = S
+        rotations = []
+        k = 0   # number of columns of H
+        nv = p  # number of basis vectors
+
+        for j in range(0, restart):
+            V = basis[-1]
+            pc = V.shape[1]
+            Z = V.copy() if M is None else M.matmat(V)
+            W = A.matmat(Z)
+
+            # Block modified Gram-Schmidt, twice for stability
+            Hcol = np.zeros((nv + pc, pc), dtype=dtype)
+            for _ in range(0, 2):
+                row = 0
+                for Vi in basis:
+                    h = Vi.conj().T @ W
+                    W -= Vi @ h
+                    Hcol[row:row + Vi.shape[1]] += h
+                    row += Vi.shape[1]
+            Vnew, Rnew = _rank_revealing_qr(W, deflation_tol)
+            r = Vnew.shape[1]
+            Hcol[nv:nv + r] = Rnew
+            Hcol = Hcol[0:nv + r]
+
+            # Apply the previous orthogonal factors, then triangularise the
+            # new block column
+            for (row0, Q) in rotations:
+                Hcol[row0:row0 + Q.shape[0]] = \
+                    Q.conj().T @ Hcol[row0:row0 + Q.shape[0]]
+            Q, Rk = np.linalg.qr(Hcol[k:nv + r], mode='complete')
+            Hcol[k:nv + r] = Rk
+            G[k:nv + r] = Q.conj().T @ G[k:nv + r]
+            rotations.append((k, Q))
+            H[0:nv + r, k:k + pc] = Hcol
+            k += pc
+            nv += r
+
+            # Residual norms of the least-squares problem
+            res[active] = np.linalg.norm(G[k:nv], axis=0) / bnorm[active]
+            if callback is not None:
+                callback(res.copy())
+            if r == 0 or np.all(res[active] <= tol):
+                break
+            basis.append(Vnew)
+
+        # Update the solution with the Krylov combination of this cycle
+        Y = scipy.linalg.solve_triangular(H[0:k, 0:k], G[0:k])
+        V = np.hstack(basis)[:, 0:k]
+        Z = V @ Y
+        if M is not None:
+            Z = M.matmat(Z)
+        X[:, active] += Z
+
+        # Recompute the true residual, which also absorbs the error of
+        # dropping nearly dependent directions
+        R = B - A.matmat(X)
+        res = np.linalg.norm(R, axis=0) / bnorm
+
+    if np.all(res <= tol):
+        return X, 0
+    return X, maxiter
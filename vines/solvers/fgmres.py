@@ -0,0 +1,92 @@
+# Flexible GMRES
+#
+# Right-preconditioned GMRES builds the solution from M V y and so
+# assumes that M is the same linear operator at every step. Inner-outer
+# schemes break this: a preconditioner that itself runs a few Krylov
+# iterations (e.g. the coarse solve of the two-grid preconditioner)
+# depends nonlinearly on the vector it is applied to. FGMRES (Saad, SIAM
+# J. Sci. Comput. 1993) stores the preconditioned vectors Z = [M v_j] and
+# builds the solution from Z y instead, which makes any preconditioner
+# admissible at the cost of a second basis of the same size.
+
+import numpy as np
+import scipy.linalg
+from scipy.sparse.linalg import aslinearoperator
+
+
+def fgmres(A, b, x0=None, M=None, tol=1e-5, restart=40, maxiter=None,
+           callback=None):
+    ''' Solve A x = b by flexible GMRES(restart), with M applied as a
+    right preconditioner that may vary from one application to the next.
+    Returns (x, info) as scipy's gmres: info = 0 on convergence,
+    otherwise the number of cycles performed. callback, if given, is
+    called with the relative residual norm after every Arnoldi step.
+
+    With tol=0 and maxiter=1 this is a fixed number (restart) of GMRES
+    steps from x0. '''
+    A = aslinearoperator(A)
+    psolve = (lambda v: v) if M is None else aslinearoperator(M).matvec
+    b = np.asarray(b).ravel()
+    n = b.shape[0]
+    dtype = np.result_type(A.dtype, b.dtype, np.complex128)
+    m = min(restart, n)
+    maxiter = 10 * n if maxiter is None else maxiter
+
+    bnorm = np.linalg.norm(b)
+    bnorm = 1.0 if bnorm == 0 else bnorm
+    x = np.zeros(n, dtype=dtype)
+    r = b.astype(dtype)
+    if x0 is not None:
+        x = np.array(x0, dtype=dtype).ravel()
+        r = r - A.matvec(x).ravel()
+
+    cycles = 0
+    while cycles < maxiter:
+        beta = np.linalg.norm(r)
+        if beta / bnorm <= tol or beta == 0:
+            break
+        V = np.zeros((n, m + 1), dtype=dtype)
+        Z = np.zeros((n, m), dtype=dtype)
+        H = np.zeros((m + 1, m), dtype=dtype)
+        # Givens rotations, for the residual norm at every step
+        cs = np.zeros(m, dtype=dtype)
+        sn = np.zeros(m, dtype=dtype)
+        g = np.zeros(m + 1, dtype=dtype)
+        g[0] = beta
+        V[:, 0] = r / beta
+        for j in range(0, m):
+            Z[:, j] = np.asarray(psolve(V[:, j].copy())).ravel()
+            w = A.matvec(Z[:, j]).ravel()
+            for _ in range(0, 2):
+                h = V[:, 0:j + 1].conj().T @ w
+                w -= V[:, 0:j + 1] @ h
+                H[0:j + 1, j] += h
+            H[j + 1, j] = np.linalg.norm(w)
+            breakdown = H[j + 1, j].real <= 1e-14 * beta
+            if not breakdown:
+                V[:, j + 1] = w / H[j + 1, j]
+
+            for i in range(0, j):
+                (a, c) = (H[i, j], H[i + 1, j])
+                H[i, j] = np.conj(cs[i]) * a + np.conj(sn[i]) * c
+                H[i + 1, j] = -sn[i] * a + cs[i] * c
+            nrm = np.hypot(abs(H[j, j]), abs(H[j + 1, j]))
+            cs[j] = H[j, j] / nrm if nrm > 0 else 1.0
+            sn[j] = H[j + 1, j] / nrm if nrm > 0 else 0.0
+            H[j, j] = nrm
+            H[j + 1, j] = 0.0
+            g[j + 1] = -sn[j] * g[j]
+            g[j] = np.conj(cs[j]) * g[j]
+            res = abs(g[j + 1]) / bnorm
+            if callback is not None:
+                callback(res)
+            if res <= tol or breakdown:
+                break
+        j += 1
+        y = scipy.linalg.solve_triangular(H[0:j, 0:j], g[0:j])
+        x += Z[:, 0:j] @ y
+        r = b - A.matvec(x).ravel()
+        cycles += 1
+
+    info = 0 if np.linalg.norm(r) / bnorm <= tol else cycles
+    return x, info
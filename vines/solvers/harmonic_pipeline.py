@@ -0,0 +1,209 @@
+# Nested-mesh harmonic pipeline for nonlinear HIFU fields
+#
+# Harmonic n of a focused field is confined to a narrower region around
+# the focus than the fundamental but has an n times shorter wavelength,
+# so each harmonic is computed on its own grid, chosen by a grid policy.
+# Its Westervelt source needs every lower harmonic on that grid (pairs
+# (m, n - m)); HarmonicPipeline resamples them one pair at a time from
+# disk and writes each finished harmonic to disk before moving on. Only
+# the grid of the harmonic being computed is held in memory, together
+# with the pages of the stored fields that are being resampled, so peak
+# memory does not grow with the number of harmonics.
+
+import os
+import tempfile
+import warnings
+import numpy as np
+from vines.geometry.resample import resample_axes
+from vines.operators.acoustic_matvecs import CirculantMatvec
+from vines.operators.operator_cache import cached_operator
+from vines.operators.operator_prefetch import (OperatorPrefetcher,
+                                               workqueue_layer)
+from vines.fields.westervelt import westervelt_coefficient
+
+
+def attenuation(f, alpha0, eta):
+    ''' Power-law attenuation alpha0 (f / MHz)^eta, converted from dB to
+    nepers '''
+    return alpha0 * (f * 1e-6)**eta / 8.686
+
+
+def grid_axes(x0, dx, nx, ny, nz):
+    ''' Axes of a grid starting at x0 along x and centred on the x-axis,
+    as built by generatedomain '''
+    return (x0 + dx * np.arange(0, nx),
+            dx * (np.arange(0, ny) - (ny - 1) / 2),
+            dx * (np.arange(0, nz) - (nz - 1) / 2))
+
+
+def grid_points(axes):
+    ''' Voxel grid r (L, M, N, 3) with the given axes, as grid3d builds
+    it but without a Numba kernel, so that it can run while an operator
+    is assembled in the background '''
+    return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+
+
+def focused_grid_policy(f1, c, focal_length, radius, x_end, nPerLam):
+    ''' Grids of the nested-mesh runs for a transducer focused along x.
+    Harmonics 1 and 2 share a grid with voxel size lambda / (2 nPerLam)
+    from near the bowl to x_end. Harmonic n >= 3 has voxel size
+    lambda_n / nPerLam and a domain narrowed by the factor 2 / n towards
+    the focus, with its far x-end half a voxel inside the previous one.
+    Returns policy(n) -> (x, y, z) axes. '''
+    lam = c / f1
+    x_start = focal_length - 0.99 * np.sqrt(focal_length**2 - radius**2)
+    width = 2 * radius
+
+    def policy(n):
+        dx = lam / (2 * nPerLam)
+        nx = int(max(1, np.round((x_end - x_start) / dx)))
+        nyz = int(max(1, np.round(width / dx)))
+        axes = grid_axes(x_start, dx, nx, nyz, nyz)
+        for m in range(3, n + 1):
+            dx_m = lam / m / nPerLam
+            x_far = axes[0][-1] - dx / 2 - dx_m / 2
+            wx = x_end - (focal_length - (focal_length - x_start) * 2 / m)
+            nx = int(max(1, np.round(wx / dx_m)))
+            nyz = int(max(1, np.round(width * 2 / m / dx_m)))
+            axes = grid_axes(x_far - (nx - 1) * dx_m, dx_m, nx, nyz, nyz)
+            dx = dx_m
+        return axes
+
+    return policy
+
+
+class HarmonicPipeline:
+    ''' Harmonics of the nonlinear field of a transducer in a homogeneous
+    medium (sound speed c, density rho, nonlinearity beta, attenuation
+    alpha0 (f / MHz)^eta dB/m), computed one at a time.
+
+    incident(k, r) returns the fundamental on the grid r (L, M, N, 3)
+    (e.g. a partial of transducers.bowl_field) and grid_policy(n) the
+    (x, y, z) axes of the grid of harmonic n (e.g. focused_grid_policy).
+    Finished harmonics are stored as .npy files in directory (a
+    temporary directory by default) and are returned memory-mapped by
+    field(n). Lower harmonics are transferred to the grid of the next
+    one by resample_axes with the given method ('linear', 'cubic' or
+    'fft'). With prefetch, run() assembles the operator of the next
+    harmonic in a background thread (OperatorPrefetcher) while the
+    product of the current one is computed; no Numba kernel runs on the
+    main thread while an assembly is pending. Under Numba's workqueue
+    threading layer, which cannot run parallel kernels from two threads
+    at all, the operators are assembled synchronously instead. '''
+
+    def __init__(self, incident, f1, c, rho, beta, alpha0, eta, grid_policy,
+                 directory=None, method='linear', prefetch=True):
+        self.incident = incident
+        self.f1 = f1
+        (self.c, self.rho, self.beta) = (c, rho, beta)
+        (self.alpha0, self.eta) = (alpha0, eta)
+        self.grid_policy = grid_policy
+        self.method = method
+        if prefetch and workqueue_layer():
+            warnings.warn('Numba workqueue threading layer: assembling '
+                          'harmonic operators synchronously')
+            prefetch = False
+        self.prefetcher = OperatorPrefetcher() if prefetch else None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='vines_harmonics_')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.axes = []
+
+    @property
+    def n_computed(self):
+        return len(self.axes)
+
+    def wavenumber(self, n):
+        f = n * self.f1
+        return 2 * np.pi * f / self.c + \
+            1j * attenuation(f, self.alpha0, self.eta)
+
+    def path(self, n):
+        return os.path.join(self.directory, 'harmonic_{0}.npy'.format(n))
+
+    def field(self, n):
+        ''' Harmonic n (1-based) on its grid, memory-mapped from disk '''
+        return np.load(self.path(n), mmap_mode='r')
+
+    def grid(self, n):
+        ''' Voxel grid r (L, M, N, 3) of harmonic n '''
+        return grid_points(self.axes[n - 1])
+
+    def resample(self, m, axes):
+        ''' Harmonic m on the grid with the given axes (zero outside the
+        grid of harmonic m) '''
+        values = self.field(m)
+        axes_m = self.axes[m - 1]
+        if all(a.shape == b.shape and np.allclose(a, b)
+               for (a, b) in zip(axes_m, axes)):
+            return np.array(values, order='F')
+        return resample_axes(values, axes_m, axes, method=self.method)
+
+    def source(self, n, axes, out):
+        ''' Westervelt source of harmonic n on the grid with the given
+        axes, accumulated into out pair by pair (see westervelt_source) '''
+        out[:] = 0.0
+        for m in range(1, n // 2 + 1):
+            A = self.resample(m, axes)
+            if 2 * m == n:
+                A *= A
+                A *= 0.5
+            else:
+                A *= self.resample(n - m, axes)
+            out += A
+            del A
+        out *= -n**2 * westervelt_coefficient(self.beta, 2 * np.pi * self.f1,
+                                              self.rho, self.c)
+        return out
+
+    def operator(self, n, r):
+        ''' Circulant spectrum of the potential for harmonic n on grid r '''
+        if self.prefetcher is None:
+            return cached_operator('potential', self.wavenumber(n), r)
+        return self.prefetcher.get(self.wavenumber(n), r)
+
+    def prefetch(self, n):
+        ''' Start assembling the operator of harmonic n >= 2 '''
+        if self.prefetcher is not None and n >= 2:
+            r = grid_points(self.grid_policy(n))
+            self.prefetcher.prefetch(self.wavenumber(n), r)
+
+    def step(self, prefetch_next=False):
+        ''' Compute the next harmonic and store it. Returns its number.
+        With prefetch_next, the operator of the harmonic after it is
+        assembled in the background meanwhile. '''
+        n = self.n_computed + 1
+        k = self.wavenumber(n)
+        axes = self.grid_policy(n)
+        r = grid_points(axes)
+        (L, M, N, _) = r.shape
+        if n == 1:
+            P = np.asfortranarray(self.incident(k, r))
+            if prefetch_next:
+                self.prefetch(n + 1)
+        else:
+            # Wait for this harmonic's operator before any Numba kernel
+            # runs (the source), so the two never overlap
+            circ_op = self.operator(n, r)
+            matvec = CirculantMatvec(circ_op, L, M, N)
+            del circ_op
+            xInVec = np.empty((L*M*N, 1), dtype=np.complex128)
+            self.source(n, axes, xInVec.reshape(L, M, N, order='F'))
+            # The Numba kernels of the source are done; overlap the next
+            # assembly with the FFTs of the product, which run no Numba
+            if prefetch_next:
+                self.prefetch(n + 1)
+            idx_all = np.ones((L, M, N), dtype=bool)
+            P = matvec.volume_potential(xInVec, idx_all, 1.0, out=xInVec)
+            P = P.reshape(L, M, N, order='F')
+            del matvec
+        np.save(self.path(n), P)
+        self.axes.append(axes)
+        return n
+
+    def run(self, n_harm):
+        ''' Compute harmonics up to n_harm (1-based) '''
+        while self.n_computed < n_harm:
+            self.step(prefetch_next=self.n_computed + 1 < n_harm)
+        return self
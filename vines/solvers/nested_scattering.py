@@ -0,0 +1,95 @@
+# Scattering of harmonic fields by an obstacle inside a larger domain
+#
+# The incident harmonics live on the whole domain (e.g. the focal region
+# of a transducer) while the VIE only needs solving over the scatterer's
+# bounding box. Per wavenumber three things are needed: the Toeplitz
+# product over the domain that turns a Westervelt source into the
+# incident harmonic, the box VIE, and the representation formula that
+# evaluates the scattered field over the domain. The first and last use
+# the same operator, T and T (k^2 Mr) differing only by the factor
+# applied to the input, so NestedScatteringSolver builds one domain
+# spectrum per wavenumber and applies the scalings at matvec time, and
+# keeps the box solver (VIESolver) for the same wavenumber next to it.
+# Only the operators of the current wavenumber are held, so memory does
+# not grow with the number of harmonics.
+
+import numpy as np
+from vines.operators.acoustic_matvecs import CirculantMatvec
+from vines.operators.operator_cache import cached_operator
+from vines.solvers.vie_solver import VIESolver
+
+
+def bounding_box(idx):
+    ''' Slices of the smallest box of voxels holding every voxel of idx '''
+    return tuple(slice(i.min(), i.max() + 1) for i in np.nonzero(idx))
+
+
+class NestedScatteringSolver:
+    ''' Fields scattered by the voxels idx (permittivities Mr = refInd^2 -
+    1, (L, M, N) arrays over the whole grid r) for incident fields given
+    over the whole grid.
+
+    volume_potential(ko, x) is the Toeplitz product T x over the domain
+    (e.g. incident harmonic n from its Westervelt source), and
+    solve(ko, u_inc) solves the VIE over the scatterer's bounding box and
+    returns the total and scattered fields over the domain. The domain
+    spectrum and the box solver are built on the first call for a
+    wavenumber and replaced when it changes. nearby_quad, prec_axis, tol,
+    m and k are passed to VIESolver. '''
+
+    def __init__(self, r, Mr, idx, nearby_quad='off', prec_axis=None,
+                 tol=1e-4, m=40, k=10):
+        (self.L, self.M, self.N, _) = r.shape
+        self.r = r
+        self.idx = idx
+        self.Mr = np.where(idx, Mr, 0.0).astype(np.complex128)
+        self.nearby_quad = nearby_quad
+        self.solver_args = dict(nearby_quad=nearby_quad, prec_axis=prec_axis,
+                                tol=tol, m=m, k=k)
+        self.box = bounding_box(idx)
+        self.r_box = r[self.box]
+        self.idx_all = np.ones((self.L, self.M, self.N), dtype=bool)
+        self.ko = None
+        self.matvec = None
+        self.engine = None
+
+    def set_wavenumber(self, ko):
+        ''' Operators for wavenumber ko (built unless already current) '''
+        if self.ko is not None and complex(ko) == complex(self.ko):
+            return
+        # Release the previous wavenumber's operators before assembling
+        self.matvec = None
+        self.engine = None
+        circ_op = cached_operator('potential', ko, self.r, self.nearby_quad)
+        self.matvec = CirculantMatvec(circ_op, self.L, self.M, self.N)
+        self.engine = VIESolver(ko, self.r_box, **self.solver_args)
+        self.engine.set_medium(self.Mr[self.box], self.idx[self.box])
+        self.ko = ko
+
+    def volume_potential(self, ko, x, out=None):
+        ''' T x over the domain for an (L, M, N) array (or a vector in
+        Fortran order) x, returned as an (L, M, N) array '''
+        (L, M, N) = (self.L, self.M, self.N)
+        self.set_wavenumber(ko)
+        xIn = np.reshape(x, (L * M * N, 1), order='F')
+        if out is not None:
+            out = out.reshape(L * M * N, 1, order='F')
+        y = self.matvec.volume_potential(xIn, self.idx_all, 1.0, out=out)
+        return y.reshape(L, M, N, order='F')
+
+    def solve(self, ko, u_inc):
+        ''' Total and scattered fields over the domain for the incident
+        field u_inc (L, M, N) '''
+        (L, M, N) = (self.L, self.M, self.N)
+        self.set_wavenumber(ko)
+        J = np.zeros((L, M, N), dtype=np.complex128, order='F')
+        J[self.box] = self.engine.solve(u_inc[self.box])
+        u_sca = self.matvec.potential_x_perm(
+            J.reshape(L * M * N, 1, order='F'), self.idx_all,
+            ko**2 * self.Mr).reshape(L, M, N, order='F')
+        return u_inc + u_sca, u_sca
+
+    @property
+    def iterations(self):
+        ''' GMRES iterations of the last box solve '''
+        return 0 if self.engine is None else len(self.engine.resvec)
@@ -0,0 +1,201 @@
+# Krylov subspace recycling (GCRO-DR)
+#
+# Convergence studies, frequency sweeps and harmonic loops solve long
+# sequences of closely related systems, and restarted GMRES rebuilds the
+# same slowly converging directions for every one of them. GCRO-DR
+# (Parks, de Sturler, Mackey, Johnson & Maiti, SIAM J. Sci. Comput. 2006)
+# keeps a k-dimensional subspace of approximate eigenvectors (harmonic
+# Ritz vectors) from the end of each solve, deflates it from the next
+# system's Krylov space and projects the initial residual onto it. When
+# the operator changes slowly (wavenumber, contrast) or only the
+# right-hand side changes, later solves need a fraction of the iterations.
+
+import numpy as np
+import scipy.linalg
+from scipy.sparse.linalg import aslinearoperator
+
+
+def _harmonic_ritz(G, WV, k):
+    ''' Coefficients (columns) of the k harmonic Ritz vectors with the
+    smallest harmonic Ritz values, from G^H G z = theta G^H W^H V z '''
+    theta, Z = scipy.linalg.eig(G.conj().T @ G, G.conj().T @ WV)
+    theta[~np.isfinite(theta)] = np.inf
+    return Z[:, np.argsort(np.abs(theta))[0:k]]
+
+
+class RecyclingGMRES:
+    ''' GCRO-DR solver that carries a recycle space from one solve to the
+    next. Call solve() for each system of the sequence; reset() discards
+    the recycle space (e.g. when moving to an unrelated problem).
+
+    m is the number of basis vectors per cycle (including the k recycled
+    ones) and k the dimension of the recycle space. With a right
+    preconditioner M the recycle space belongs to A M, so M should stay
+    the same (or change slowly) along the sequence. '''
+
+    def __init__(self, m=40, k=10, tol=1e-5, maxiter=None):
+        if not 0 < k < m:
+            raise ValueError('Need 0 < k < m')
+        self.m = m
+        self.k = k
+        self.tol = tol
+        self.maxiter = maxiter
+        self.U = None
+
+    def reset(self):
+        self.U = None
+
+    def solve(self, A, b, x0=None, M=None, callback=None):
+        ''' Solve A x = b. Returns (x, info) as scipy's gmres: info = 0 on
+        convergence, otherwise the number of cycles performed. callback,
+        if given, is called with the relative residual norm after every
+        Arnoldi step. '''
+        A = aslinearoperator(A)
+        M = None if M is None else aslinearoperator(M)
+        b = np.asarray(b).ravel()
+        n = b.shape[0]
+        dtype = np.result_type(A.dtype, b.dtype, np.complex128)
+        (m, k, tol) = (self.m, self.k, self.tol)
+        maxiter = 10 * n if self.maxiter is None else self.maxiter
+
+        def op(v):
+            v = v.copy() if M is None else M.matvec(v.copy())
+            return A.matvec(v).ravel()
+
+        bnorm = np.linalg.norm(b)
+        bnorm = 1.0 if bnorm == 0 else bnorm
+        # Solve for y in A M y = b, x = M y
+        y = np.zeros(n, dtype=dtype)
+        r = b.astype(dtype)
+        if x0 is not None:
+            if M is not None:
+                raise ValueError('x0 is not supported with a preconditioner')
+            y = np.array(x0, dtype=dtype).ravel()
+            r = r - op(y)
+        if np.linalg.norm(r) / bnorm <= tol:
+            # Zero right-hand side or exact x0: nothing to solve, and no
+            # Krylov space to recycle
+            x = y if M is None else M.matvec(y)
+            return np.asarray(x).ravel(), 0
+
+        cycles = 0
+        if self.U is not None and self.U.shape[0] == n:
+            # Adapt the recycle space to the current operator:
+            # C = A M U orthonormal, U scaled accordingly
+            U = self.U
+            C, R = np.linalg.qr(np.column_stack([op(U[:, i])
+                                                 for i in range(U.shape[1])]))
+            U = scipy.linalg.solve_triangular(R, U.T, trans='T').T
+            y += U @ (C.conj().T @ r)
+            r -= C @ (C.conj().T @ r)
+        else:
+            # First solve: one GMRES(m) cycle supplies the recycle space
+            V, H, j = self._arnoldi(op, r, m, None, n, dtype, bnorm, tol,
+                                    callback)
+            beta = np.linalg.norm(r)
+            rhs = np.zeros(j + 1, dtype=dtype)
+            rhs[0] = beta
+            z = np.linalg.lstsq(H[0:j + 1, 0:j], rhs, rcond=None)[0]
+            y += V[:, 0:j] @ z
+            r -= V[:, 0:j + 1] @ (H[0:j + 1, 0:j] @ z)
+            cycles += 1
+            kk = min(k, j)
+            WV = np.eye(j + 1, j, dtype=dtype)
+            P = _harmonic_ritz(H[0:j + 1, 0:j], WV, kk)
+            Q, R = np.linalg.qr(H[0:j + 1, 0:j] @ P)
+            C = V[:, 0:j + 1] @ Q
+            U = scipy.linalg.solve_triangular(R, (V[:, 0:j] @ P).T,
+                                              trans='T').T
+
+        while np.linalg.norm(r) / bnorm > tol and cycles < maxiter:
+            kk = U.shape[1]
+            V, H, j = self._arnoldi(op, r, m - kk, C, n, dtype, bnorm,
+                                    tol, callback)
+            # Coupling of the new Krylov vectors to the recycle space
+            Bk = H[j + 1:, 0:j]
+            H = H[0:j + 1, 0:j]
+            d = 1.0 / np.linalg.norm(U, axis=0)
+            Ut = U * d
+            Vhat = np.hstack((Ut, V[:, 0:j]))
+            What = np.hstack((C, V[:, 0:j + 1]))
+            G = np.zeros((kk + j + 1, kk + j), dtype=dtype)
+            G[0:kk, 0:kk] = np.diag(d)
+            G[0:kk, kk:] = Bk
+            G[kk:, kk:] = H
+            rhs = What.conj().T @ r
+            z = np.linalg.lstsq(G, rhs, rcond=None)[0]
+            y += Vhat @ z
+            r -= What @ (G @ z)
+            cycles += 1
+
+            # New recycle space from the harmonic Ritz vectors of this cycle
+            P = _harmonic_ritz(G, What.conj().T @ Vhat, min(k, kk + j))
+            Q, R = np.linalg.qr(G @ P)
+            C = What @ Q
+            U = scipy.linalg.solve_triangular(R, (Vhat @ P).T,
+                                              trans='T').T
+
+        self.U = U
+        x = y if M is None else M.matvec(y)
+        info = 0 if np.linalg.norm(r) / bnorm <= tol else cycles
+        return np.asarray(x).ravel(), info
+
+    @staticmethod
+    def _arnoldi(op, r, steps, C, n, dtype, bnorm, tol, callback):
+        ''' Arnoldi with (I - C C^H) op started from r. Returns the basis V
+        (n, j + 1), the Hessenberg matrix H and the number of steps j;
+        when C is given, H has C^H op V appended below its Hessenberg
+        part. '''
+        kk = 0 if C is None else C.shape[1]
+        V = np.zeros((n, steps + 1), dtype=dtype)
+        H = np.zeros((steps + 1 + kk, steps), dtype=dtype)
+        beta = np.linalg.norm(r)
+        if beta == 0:
+            # r = 0: the Krylov space is empty
+            return V[:, 0:1], H[np.r_[0, steps + 1:steps + 1 + kk], 0:0], 0
+        V[:, 0] = r / beta
+        # Givens rotations, for the residual norm at every step
+        cs = np.zeros(steps, dtype=dtype)
+        sn = np.zeros(steps, dtype=dtype)
+        g = np.zeros(steps + 1, dtype=dtype)
+        g[0] = beta
+        R = np.zeros((steps + 1, steps), dtype=dtype)
+        for j in range(0, steps):
+            w = op(V[:, j])
+            if C is not None:
+                bk = C.conj().T @ w
+                w -= C @ bk
+                H[steps + 1:, j] = bk
+            for _ in range(0, 2):
+                h = V[:, 0:j + 1].conj().T @ w
+                w -= V[:, 0:j + 1] @ h
+                H[0:j + 1, j] += h
+            H[j + 1, j] = np.linalg.norm(w)
+
+            R[0:j + 2, j] = H[0:j + 2, j]
+            for i in range(0, j):
+                (a, c) = (R[i, j], R[i + 1, j])
+                R[i, j] = np.conj(cs[i]) * a + np.conj(sn[i]) * c
+                R[i + 1, j] = -sn[i] * a + cs[i] * c
+            nrm = np.hypot(abs(R[j, j]), abs(R[j + 1, j]))
+            cs[j] = R[j, j] / nrm if nrm > 0 else 1.0
+            sn[j] = R[j + 1, j] / nrm if nrm > 0 else 0.0
+            g[j + 1] = -sn[j] * g[j]
+            g[j] = np.conj(cs[j]) * g[j]
+            res = abs(g[j + 1]) / bnorm
+            if callback is not None:
+                callback(res)
+
+            if H[j + 1, j].real <= 1e-14 * beta:
+                # Lucky breakdown: the solution lies in the current space
+                break
+            V[:, j + 1] = w / H[j + 1, j]
+            if res <= tol:
+                break
+        j += 1
+        if kk:
+            # Move C^H op V below the (j + 1) x j Hessenberg block
+            H = np.vstack((H[0:j + 1, 0:j], H[steps + 1:, 0:j]))
+        else:
+            H = H[0:j + 1, 0:j]
+        return V[:, 0:j + 1], H, j
@@ -0,0 +1,111 @@
+# Acoustic VIE solver engine
+#
+# Everything that depends only on the wavenumber and the voxel grid (the
+# circulant spectrum, FFTW plans and scratch buffers, and the Toeplitz
+# generators of the preconditioner) is built once by VIESolver. The
+# medium and the incident field are then cheap updates, so frequency
+# sweeps, harmonic cascades at a fixed harmonic and parameter studies
+# reuse every expensive piece. Successive solves also share a Krylov
+# recycle space (RecyclingGMRES), which pays off when consecutive
+# systems are related.
+
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+from vines.operators.acoustic_matvecs import CirculantMatvec
+from vines.operators.operator_cache import cached_operator
+from vines.solvers.recycling_gmres import RecyclingGMRES
+
+
+class VIESolver:
+    ''' Solver for (I - k^2 Mr T) u = u_inc on the voxel grid r.
+
+    set_medium(Mr, idx) sets the permittivities (refInd^2 - 1) and the
+    scatterer voxels; solve(u_inc) then returns the field in the
+    scatterer, after which scattered_field() and total_field() evaluate
+    the representation formula over the whole grid.
+
+    With prec_axis given, GMRES is right-preconditioned by the
+    variable-contrast 2-level circulant preconditioner with blocks along
+    that axis (circ2_variable_acoustic); it is rebuilt only when the
+    medium changes. tol, m and k are passed to RecyclingGMRES. '''
+
+    def __init__(self, ko, r, nearby_quad='off', prec_axis=None, tol=1e-4,
+                 m=40, k=10):
+        (self.L, self.M, self.N, _) = r.shape
+        self.ko = ko
+        self.r = r
+        self.nearby_quad = nearby_quad
+        self.prec_axis = prec_axis
+        self.n_voxel = self.L * self.M * self.N
+        # Circulant embedding of the Toeplitz operator (cached on disk). The
+        # k**2 factor of the operator is applied to the permittivities
+        self.circ_op = cached_operator('potential', ko, r, nearby_quad)
+        self.matvec = CirculantMatvec(self.circ_op, self.L, self.M, self.N)
+        self.A = LinearOperator((self.n_voxel, self.n_voxel),
+                                dtype=np.complex128, matvec=self._mvp)
+        self.gmres = RecyclingGMRES(m=m, k=k, tol=tol)
+        self.toep = None
+        self.prec = None
+        self.Mr = None
+        self.idx = None
+        self.sol = None
+        self.info = None
+        self.resvec = []
+
+    def _mvp(self, x):
+        return self.matvec.vec(x.copy(), self.idx, self.Mr)
+
+    def set_medium(self, Mr, idx):
+        ''' New permittivities Mr (L, M, N) and scatterer voxels idx '''
+        self.Mr = self.ko**2 * Mr
+        self.idx = idx
+        self.prec = None
+        if self.prec_axis is not None:
+            self._build_preconditioner()
+
+    def _build_preconditioner(self):
+        from vines.operators.acoustic_operators import volume_potential
+        from vines.precondition.circulant_acoustic import (
+            circ2_variable_acoustic, mvp_circ2_acoustic_var)
+        if self.toep is None:
+            self.toep = volume_potential(self.ko, self.r, self.nearby_quad)
+        circ2_var = circ2_variable_acoustic(self.toep, self.Mr, self.idx,
+                                            self.prec_axis)
+        (L, M, N, idx) = (self.L, self.M, self.N, self.idx)
+        self.prec = LinearOperator(
+            (self.n_voxel, self.n_voxel), dtype=np.complex128,
+            matvec=lambda x: mvp_circ2_acoustic_var(x.copy(), circ2_var,
+                                                    L, M, N, idx))
+
+    def solve(self, u_inc):
+        ''' Field in the scatterer for the incident field u_inc, given
+        either on the whole grid (L, M, N) or at the scatterer voxels.
+        Returns the solution as an (L, M, N) array. '''
+        if self.Mr is None:
+            raise ValueError('Call set_medium() before solve()')
+        (L, M, N) = (self.L, self.M, self.N)
+        xIn = np.zeros((L, M, N), dtype=np.complex128)
+        xIn[self.idx] = u_inc[self.idx] if np.shape(u_inc) == (L, M, N) \
+            else u_inc
+        self.resvec = []
+        sol, self.info = self.gmres.solve(
+            self.A, xIn.reshape(-1, order='F'), M=self.prec,
+            callback=self.resvec.append)
+        self.sol = sol.reshape(L, M, N, order='F')
+        return self.sol
+
+    def scattered_field(self, sol=None):
+        ''' Scattered field over the whole grid, T (k^2 Mr) u, for the last
+        solution (or sol) '''
+        (L, M, N) = (self.L, self.M, self.N)
+        sol = self.sol if sol is None else sol
+        idx_all = np.ones((L, M, N), dtype=bool)
+        u_sca = self.matvec.potential_x_perm(
+            np.array(sol, dtype=np.complex128).reshape(-1, order='F'),
+            idx_all, self.Mr)
+        return u_sca.reshape(L, M, N, order='F')
+
+    def total_field(self, u_inc, sol=None):
+        ''' Total field over the whole grid for the incident field u_inc
+        (L, M, N) '''
+        return u_inc + self.scattered_field(sol)